@@ -3,7 +3,8 @@ from django.contrib import admin
 from edc_base.modeladmin.admin import LimitedAdminInlineMixin
 from getresults.admin import admin_site
 
-from .models import ExportHistory, ImportHistory, CsvFormat, CsvField, CsvDictionary
+from .models import (
+    ArchiveEntry, ExportHistory, ImportHistory, ImportedIdentifier, ImportRollup, CsvFormat, CsvField, CsvDictionary)
 from getresults_csv.forms import CsvDictionaryForm
 
 
@@ -38,11 +39,41 @@ admin_site.register(CsvFormat, CsvFormatAdmin)
 
 
 class ImportHistoryAdmin(admin.ModelAdmin):
-    list_display = ('source', 'import_datetime', 'record_count')
-    search_fields = ('source', 'import_datetime', 'record_count')
+    list_display = ('source', 'csv_format', 'import_datetime', 'success', 'record_count')
+    list_filter = ('success', 'csv_format')
+    search_fields = ('^source', )
+    date_hierarchy = 'import_datetime'
 admin_site.register(ImportHistory, ImportHistoryAdmin)
 
 
+class ImportRollupAdmin(admin.ModelAdmin):
+    list_display = ('import_date', 'csv_format', 'files', 'records', 'failures')
+    list_filter = ('csv_format', )
+    date_hierarchy = 'import_date'
+admin_site.register(ImportRollup, ImportRollupAdmin)
+
+
+class ImportedIdentifierAdmin(admin.ModelAdmin):
+    list_display = ('order_identifier', 'import_history', 'row_number')
+    list_select_related = ('import_history', )
+    search_fields = ('order_identifier', )
+    raw_id_fields = ('import_history', )
+
+    def get_search_results(self, request, queryset, search_term):
+        """Searches by exact identifier so the index on order_identifier is used."""
+        if search_term.strip():
+            return queryset.filter(order_identifier=search_term.strip()), False
+        return queryset, False
+admin_site.register(ImportedIdentifier, ImportedIdentifierAdmin)
+
+
+class ArchiveEntryAdmin(admin.ModelAdmin):
+    list_display = ('source_filename', 'archive_datetime', 'archive_path', 'bundle')
+    search_fields = ('^source_filename', '=content_hash')
+    date_hierarchy = 'archive_datetime'
+admin_site.register(ArchiveEntry, ArchiveEntryAdmin)
+
+
 class ExportHistoryAdmin(admin.ModelAdmin):
     list_display = ('destination', 'export_datetime', 'reference')
     search_fields = ('destination', 'export_datetime', 'reference')
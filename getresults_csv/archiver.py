@@ -0,0 +1,207 @@
+import gzip
+import logging
+import lzma
+import os
+import queue
+import shutil
+import tarfile
+import threading
+
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ArchiveEntry
+
+try:
+    ARCHIVE_COMPRESSION = settings.GETRESULTS_CSV_ARCHIVE_COMPRESSION
+except AttributeError:
+    ARCHIVE_COMPRESSION = 'gzip'  # or 'lzma' or None
+
+try:
+    ARCHIVE_RETENTION_DAYS = settings.GETRESULTS_CSV_ARCHIVE_RETENTION_DAYS
+except AttributeError:
+    ARCHIVE_RETENTION_DAYS = 30  # days kept as single files before compact_archive bundles them
+
+COMPRESSORS = {
+    'gzip': ('.gz', gzip.open),
+    'lzma': ('.xz', lzma.open),
+}
+
+PENDING_DIR = 'pending'
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+logger = logging.getLogger(__name__)
+
+
+class Archiver(object):
+    """Moves imported files into a date sharded, compressed archive.
+
+    :meth:`archive` only renames the file into the `pending` folder of the
+    archive_dir and returns the path the file will have in the archive,
+    `archive_dir/YYYY/MM/DD/<filename>.<timestamp>.<token>.gz`. The timestamp
+    has microseconds and the token is the start of the content hash (or
+    random), so that files of the same name archived at the same time do not
+    overwrite each other; should the path still be taken, by an archived or a
+    queued file, a number is added, see :meth:`reserve_archive_path`. While the
+    worker thread is running (see :meth:`start`) the file is compressed and
+    catalogued in ArchiveEntry in the background, otherwise at once. Errors of
+    the worker are reported through `output(message)`, or logged if it is not given."""
+
+    def __init__(self, archive_dir, compression=None, output=None):
+        self.archive_dir = archive_dir
+        self.output = output or logger.warning
+        self.compression = ARCHIVE_COMPRESSION if compression is None else compression
+        if self.compression and self.compression not in COMPRESSORS:
+            raise ValueError('Invalid archive compression. Expected one of {}. Got {}.'.format(
+                list(COMPRESSORS), self.compression))
+        self.pending_dir = os.path.join(self.archive_dir, PENDING_DIR)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reserved = set()  # archive paths of queued files
+
+    def __str__(self):
+        return 'Archiver({}, compression={})'.format(self.archive_dir, self.compression)
+
+    def archive(self, src_path, content_hash=None, now=None):
+        """Moves src_path out of the source folder and returns its archive path."""
+        now = now or datetime.now()
+        token = (content_hash or uuid4().hex)[:8]
+        filename = '{}.{}.{}'.format(os.path.basename(src_path), now.strftime(TIMESTAMP_FORMAT), token)
+        os.makedirs(self.pending_dir, exist_ok=True)
+        pending_path = os.path.join(self.pending_dir, filename)
+        shutil.move(src_path, pending_path)
+        archive_path = self.reserve_archive_path(self.get_archive_path(filename, now))
+        item = (pending_path, archive_path, os.path.basename(src_path), content_hash)
+        if self.thread:
+            self.queue.put(item)
+        else:
+            self.compress(*item)
+        return archive_path
+
+    def get_archive_path(self, filename, now):
+        extension = COMPRESSORS[self.compression][0] if self.compression else ''
+        shard = os.path.join(self.archive_dir, now.strftime('%Y'), now.strftime('%m'), now.strftime('%d'))
+        return os.path.join(shard, filename + extension)
+
+    def reserve_archive_path(self, archive_path):
+        """Returns archive_path or, if an archived or queued file already has
+        that path, archive_path with a number added.
+
+        The path is reserved until the file is written, see :meth:`compress`."""
+        root, extension = os.path.splitext(archive_path) if self.compression else (archive_path, '')
+        index = 0
+        with self.lock:
+            while archive_path in self.reserved or os.path.exists(archive_path):
+                index += 1
+                archive_path = '{}.{}{}'.format(root, index, extension)
+            self.reserved.add(archive_path)
+        return archive_path
+
+    def compress(self, pending_path, archive_path, source_filename, content_hash):
+        """Writes the pending file to its reserved archive path and records an ArchiveEntry."""
+        try:
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            if self.compression:
+                tmp_path = archive_path + '.tmp'
+                with open(pending_path, 'rb') as src, COMPRESSORS[self.compression][1](tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.rename(tmp_path, archive_path)
+                os.remove(pending_path)
+            else:
+                shutil.move(pending_path, archive_path)
+        finally:
+            with self.lock:
+                self.reserved.discard(archive_path)
+        ArchiveEntry.objects.create(
+            source_filename=source_filename,
+            content_hash=content_hash,
+            archive_path=archive_path)
+
+    def recover(self):
+        """Archives files left in the pending folder, e.g. by a stopped process."""
+        if not os.path.isdir(self.pending_dir):
+            return
+        for entry in os.scandir(self.pending_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                parts = entry.name.rsplit('.', 2)
+                try:
+                    source_filename, now = parts[0], datetime.strptime(parts[1], TIMESTAMP_FORMAT)
+                except (IndexError, ValueError):  # a name without a token, <filename>.<timestamp>
+                    source_filename = entry.name.rsplit('.', 1)[0]
+                    now = datetime.fromtimestamp(entry.stat().st_mtime)
+                archive_path = self.reserve_archive_path(self.get_archive_path(entry.name, now))
+                self.queue.put((entry.path, archive_path, source_filename, None))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.compress(*item)
+            except Exception as e:
+                self.output('{} unable to archive \'{}\'. Got {}'.format(timezone.now(), item[0], str(e)))
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.worker)
+            self.thread.daemon = True
+            self.thread.start()
+            self.recover()
+
+    def join(self):
+        """Waits until all queued files are archived."""
+        self.queue.join()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def compact_archive(archive_dir, days=None, today=None):
+    """Rolls each day folder older than days into one tar bundle, `YYYY/MM/YYYYMMDD.tar`.
+
+    The ArchiveEntry of each file is updated with its bundle and the day
+    folder is removed. Returns the list of bundles written."""
+    days = ARCHIVE_RETENTION_DAYS if days is None else days
+    today = today or datetime.now().date()
+    bundles = []
+    for year in sorted(os.listdir(archive_dir)):
+        if not year.isdigit():
+            continue
+        for month in sorted(os.listdir(os.path.join(archive_dir, year))):
+            month_dir = os.path.join(archive_dir, year, month)
+            if not month.isdigit() or not os.path.isdir(month_dir):
+                continue
+            for day in sorted(os.listdir(month_dir)):
+                day_dir = os.path.join(month_dir, day)
+                if not day.isdigit() or not os.path.isdir(day_dir):
+                    continue
+                date = datetime(int(year), int(month), int(day)).date()
+                if date > today - timedelta(days=days):
+                    continue
+                bundles.append(bundle_day(day_dir, os.path.join(month_dir, '{}{}{}.tar'.format(year, month, day))))
+    return bundles
+
+
+def bundle_day(day_dir, bundle):
+    """Adds the files of day_dir to the tar bundle and removes day_dir."""
+    with tarfile.open(bundle, 'a') as tar:
+        for entry in sorted(os.scandir(day_dir), key=lambda entry: entry.name):
+            if entry.is_file():
+                tar.add(entry.path, arcname=entry.name)
+    ArchiveEntry.objects.filter(
+        archive_path__startswith=day_dir + os.sep).update(bundle=bundle)
+    shutil.rmtree(day_dir)
+    return bundle
@@ -0,0 +1,58 @@
+"""Compares csv.reader with the simple split tokenizer on a rad9A6A3.csv-shaped file.
+
+Usage:
+
+    python -m getresults_csv.benchmark [rows] [repeat]
+
+Writes a temporary tab delimited file with the header of testdata/rad9A6A3.csv
+and its data rows repeated to `rows` rows, then reports the best of `repeat`
+runs for each tokenizer.
+"""
+import csv
+import os
+import sys
+import tempfile
+import timeit
+
+from getresults_csv.tokenizer import simple_split_reader
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testdata', 'rad9A6A3.csv')
+
+
+def make_file(rows, sample_file=None):
+    with open(sample_file or SAMPLE_FILE, 'r', encoding='utf-8', newline='') as f:
+        lines = [line.rstrip('\r\n') for line in f]
+    header, data = lines[0], lines[1:]
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+        f.write(header + '\r')
+        for index in range(rows):
+            f.write(data[index % len(data)] + '\r')
+    return filename
+
+
+def tokenize(filename, reader):
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        for _ in reader(f, '\t'):
+            pass
+
+
+def csv_reader(f, delimiter):
+    return csv.reader(f, delimiter=delimiter)
+
+
+def main(rows=10000, repeat=5):
+    filename = make_file(rows)
+    try:
+        results = []
+        for name, reader in [('csv.reader', csv_reader), ('simple_split', simple_split_reader)]:
+            seconds = min(timeit.repeat(lambda: tokenize(filename, reader), number=1, repeat=repeat))
+            results.append(seconds)
+            sys.stdout.write('{:<14}{:>8.3f}s  {:>10.0f} rows/s\n'.format(name, seconds, rows / seconds))
+        sys.stdout.write('speedup       {:>8.2f}x\n'.format(results[0] / results[1]))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
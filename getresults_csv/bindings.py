@@ -0,0 +1,70 @@
+import csv
+import os
+
+from .csv_file_handler import CsvFileHandler
+
+BINDINGS_HEADER_ROW = ['csv_format', 'source_dir', 'patterns', 'archive_dir']
+
+# columns that may follow BINDINGS_HEADER_ROW
+OPTIONAL_BINDINGS_COLUMNS = ['tail_patterns', 'polling']
+
+
+def read_bindings(filename):
+    """Returns a list of bindings read from a CSV file.
+
+    Each row binds a source folder to a CSV format name (or 'auto' to route by
+    header), file patterns separated by '|' and an archive folder. Relative
+    folders are relative to the folder of the bindings file. If patterns is
+    blank the save handler's file patterns are used; if archive_dir is blank
+    the 'archive' subfolder of the source folder is used. The optional
+    tail_patterns column lists the patterns of files that are appended to
+    and imported incrementally, see CsvFileHandler. If the optional polling
+    column is 'yes' the folder is polled instead of watched for events."""
+    bindings = []
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter=',')
+        header_row = next(reader)
+        columns = BINDINGS_HEADER_ROW + OPTIONAL_BINDINGS_COLUMNS[:len(header_row) - len(BINDINGS_HEADER_ROW)]
+        if header_row != columns:
+            raise ValueError(
+                'Cannot read bindings from {}. Invalid header row. Expected {}'.format(
+                    filename, BINDINGS_HEADER_ROW))
+        for row in reader:
+            if not row:
+                continue
+            row = dict(zip(columns, [value.strip() for value in row]))
+            source_dir = os.path.join(base_dir, os.path.expanduser(row['source_dir']))
+            if row['archive_dir']:
+                archive_dir = os.path.join(base_dir, os.path.expanduser(row['archive_dir']))
+            else:
+                archive_dir = os.path.join(source_dir, 'archive')
+            bindings.append(dict(
+                csv_format=None if row['csv_format'] == 'auto' else row['csv_format'],
+                source_dir=source_dir,
+                patterns=[p for p in row['patterns'].split('|') if p] or None,
+                archive_dir=archive_dir,
+                tail_patterns=[p for p in row.get('tail_patterns', '').split('|') if p] or None,
+                polling=row.get('polling', '').lower() in ['yes', 'y', 'true', '1']))
+    return bindings
+
+
+def make_event_handlers(bindings, save_handler_class, **kwargs):
+    """Returns a CsvFileHandler, each with its own save handler, for each binding.
+
+    save_handler_class is any callable that returns a new save handler. It is
+    also used to give each save thread of an ImportPipeline its own save handler."""
+    event_handlers = []
+    for binding in bindings:
+        save_handler = save_handler_class()
+        event_handlers.append(CsvFileHandler(
+            csv_format=binding['csv_format'],
+            source_dir=binding['source_dir'],
+            archive_dir=binding['archive_dir'],
+            patterns=binding['patterns'] or save_handler.file_patterns,
+            save_handler=save_handler,
+            save_handler_factory=save_handler_class,
+            tail_patterns=binding.get('tail_patterns'),
+            polling=binding.get('polling'),
+            **kwargs))
+    return event_handlers
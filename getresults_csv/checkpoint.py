@@ -0,0 +1,62 @@
+import hashlib
+import os
+
+from .format_plan import read_raw_header
+from .models import ImportCheckpoint
+
+
+def get_checkpoint(path):
+    """Returns the ImportCheckpoint of an interrupted import of the file or None.
+
+    A checkpoint of a file that has since changed (size or mtime) is deleted."""
+    try:
+        checkpoint = ImportCheckpoint.objects.get(source_path=path)
+    except ImportCheckpoint.DoesNotExist:
+        return None
+    stat = os.stat(path)
+    if (checkpoint.file_size, checkpoint.file_mtime) != (stat.st_size, stat.st_mtime):
+        checkpoint.delete()
+        return None
+    return checkpoint
+
+
+def get_tail_checkpoint(path):
+    """Returns the ImportCheckpoint of a tailed file, creating it if needed.
+
+    If the file was truncated (its size is below the offset) or replaced, e.g.
+    rotated (its inode or header line changed), the checkpoint is reset to
+    the start of the file."""
+    stat = os.stat(path)
+    header_hash = hashlib.sha1(read_raw_header(path)).hexdigest()
+    checkpoint, created = ImportCheckpoint.objects.get_or_create(
+        source_path=path,
+        defaults=dict(
+            file_size=stat.st_size,
+            file_mtime=stat.st_mtime,
+            inode=stat.st_ino,
+            header_hash=header_hash))
+    replaced = checkpoint.inode != stat.st_ino or checkpoint.header_hash != header_hash
+    if not created and (replaced or stat.st_size < checkpoint.offset):
+        checkpoint.offset = 0
+        checkpoint.line_num = 1
+        checkpoint.inode = stat.st_ino
+        checkpoint.header_hash = header_hash
+        checkpoint.save()
+    return checkpoint
+
+
+def save_checkpoint(path, offset, line_num):
+    """Records that the rows of the file up to byte offset, or if the file was
+    not read through a memory map (offset is None) up to line_num, are saved."""
+    stat = os.stat(path)
+    ImportCheckpoint.objects.update_or_create(
+        source_path=path,
+        defaults=dict(
+            file_size=stat.st_size,
+            file_mtime=stat.st_mtime,
+            offset=offset or 0,
+            line_num=line_num))
+
+
+def clear_checkpoint(path):
+    ImportCheckpoint.objects.filter(source_path=path).delete()
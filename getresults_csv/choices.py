@@ -7,3 +7,14 @@ PROCESS_FIELDS = (
     ('result_datetime', 'result_datetime'),
     ('operator', 'operator'),
 )
+
+# datatype of the value of each processing field, see converters.py
+PROCESS_FIELD_DATATYPES = {
+    'sender_panel': 'string',
+    'sender': 'string',
+    'serial_number': 'string',
+    'collection_date': 'datetime',
+    'order_identifier': 'string',
+    'result_datetime': 'datetime',
+    'operator': 'string',
+}
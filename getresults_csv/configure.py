@@ -2,9 +2,14 @@ import codecs
 import csv
 import os
 
+from collections import OrderedDict
 from decimal import Decimal, InvalidOperation
+from uuid import uuid4
+
 from django.conf import settings
+from django.db import transaction
 from getresults_order.models import Utestid
+from getresults_csv.format_plan import clear_format_plans
 from getresults_csv.models import CsvFormat, CsvDictionary, CsvField
 from getresults_sender.models import SenderModel
 
@@ -20,9 +25,13 @@ class Configure(object):
           that csv_fields are created.
         * csv_dictionaries.csv: links the csv_format, it's csv_fields to field labels.
           Field labels will be converted to either utestids or "processing field" name.
+
+    With bulk=True the files are loaded by :meth:`bulk_load_all`.
     """
-    def __init__(self, csv_formats_filename=None, csv_dictionaries_filename=None, import_path=None, load=None):
+    def __init__(self, csv_formats_filename=None, csv_dictionaries_filename=None, import_path=None, load=None,
+                 bulk=None):
         load = True if load is None else load
+        self.bulk = bulk
         self.import_path = import_path or os.path.join(settings.BASE_DIR, 'testdata')
         self.csv_formats_filename = (
             csv_formats_filename or os.path.join(settings.BASE_DIR, 'testdata/csv_formats.csv'))
@@ -39,6 +48,8 @@ class Configure(object):
 
     def load_all(self):
         """Loads all three files in the correct order."""
+        if self.bulk:
+            return self.bulk_load_all()
         self.load_one(
             filename=self.csv_formats_filename,
             header_row=self.csv_formats_header_row,
@@ -51,13 +62,101 @@ class Configure(object):
     def load_one(self, filename, header_row, create_func):
         """Loads one file, confirms header row and creates using create_func if
         the instance does not already exist."""
+        for row in self.read_rows(filename, header_row):
+            create_func(row)
+
+    def read_rows(self, filename, header_row):
+        """Returns the rows of a file as a list of dictionaries after confirming the header row."""
         with open(filename, 'r', encoding='utf-8', newline='') as f:
             reader = csv.reader(f, delimiter=',')
             csv_header_row = next(reader)
             self.match_header_row_or_raise(csv_header_row, header_row, filename)
-            for row in reader:
-                row = dict(zip(header_row, row))
-                create_func(row)
+            return [dict(zip(header_row, row)) for row in reader]
+
+    def bulk_load_all(self):
+        """Loads the csv formats and csv dictionaries in one transaction.
+
+        Existing keys are read once and the missing CsvFormat, CsvField and
+        CsvDictionary instances are inserted with bulk_create. The model save()
+        methods and signals are not called; their work (reading the sample
+        header, creating the csv fields, resolving field labels) is done here."""
+        csv_format_rows = self.read_rows(self.csv_formats_filename, self.csv_formats_header_row)
+        csv_dictionary_rows = self.read_rows(self.csv_dictionaries_filename, self.csv_dictionaries_header_row)
+        with transaction.atomic():
+            self.bulk_create_csv_formats(csv_format_rows)
+            self.bulk_create_csv_dictionaries(csv_dictionary_rows)
+        clear_format_plans()
+
+    def bulk_create_csv_formats(self, rows):
+        """Creates the csv formats, and the csv fields of their headers, that do not already exist."""
+        existing = set(name.lower() for name in CsvFormat.objects.values_list('name', flat=True))
+        sender_models = {
+            sender_model.name: sender_model for sender_model in SenderModel.objects.filter(
+                name__in=[row.get('sender_model') for row in rows if row.get('sender_model')])}
+        csv_formats = []
+        for row in rows:
+            if not row.get('name') or row.get('name').lower() in existing:
+                continue
+            existing.add(row.get('name').lower())
+            if row.get('sample_file'):
+                sample_file = os.path.join(self.import_path, row.get('sample_file'))
+            else:
+                sample_file = None
+            csv_format = CsvFormat(
+                id=uuid4(),
+                name=row.get('name'),
+                sender_model=sender_models.get(row.get('sender_model')),
+                sample_file=sample_file,
+                delimiter=codecs.decode(row.get('delimiter').strip() or ',', 'unicode_escape'),
+                encoding=row.get('encoding', 'utf-8'))
+            if csv_format.sample_file:
+                csv_format.read_sample_header()
+            csv_formats.append(csv_format)
+        CsvFormat.objects.bulk_create(csv_formats)
+        csv_fields = []
+        for csv_format in csv_formats:
+            for name in OrderedDict.fromkeys(csv_format.get_header_as_list()):
+                csv_fields.append(CsvField(id=uuid4(), csv_format=csv_format, name=name))
+        CsvField.objects.bulk_create(csv_fields, batch_size=500)
+        return csv_formats
+
+    def bulk_create_csv_dictionaries(self, rows):
+        """Creates the csv dictionaries that do not already exist.
+
+        Note: the csv_formats and utestids must already exist, see create_csv_dictionary."""
+        csv_formats = {csv_format.name.lower(): csv_format for csv_format in CsvFormat.objects.all()}
+        csv_fields = {
+            (csv_field.csv_format_id, csv_field.name.lower()): csv_field
+            for csv_field in CsvField.objects.filter(csv_format__in=list(csv_formats.values()))
+            if csv_field.name}
+        existing = set(CsvDictionary.objects.values_list('csv_format_id', 'csv_field_id'))
+        utestids = {
+            utestid.name: utestid for utestid in Utestid.objects.filter(
+                name__in=[row.get('field_label') for row in rows if row.get('field_label')])}
+        csv_dictionaries = []
+        for row in rows:
+            try:
+                csv_format = csv_formats[row.get('csv_format').lower()]
+            except KeyError:
+                raise CsvFormat.DoesNotExist(
+                    'CsvFormat matching query does not exist. Got \'{}\''.format(row.get('csv_format')))
+            try:
+                csv_field = csv_fields[(csv_format.pk, row.get('csv_field').lower())]
+            except KeyError:
+                raise CsvField.DoesNotExist(
+                    'CsvField matching query does not exist. Got \'{}\''.format(row.get('csv_field')))
+            if (csv_format.pk, csv_field.pk) in existing:
+                continue
+            existing.add((csv_format.pk, csv_field.pk))
+            utestid = utestids.get(row.get('field_label'))
+            csv_dictionaries.append(CsvDictionary(
+                id=uuid4(),
+                csv_format=csv_format,
+                csv_field=csv_field,
+                utestid=utestid,
+                processing_field=None if utestid else row.get('field_label')))
+        CsvDictionary.objects.bulk_create(csv_dictionaries, batch_size=500)
+        return csv_dictionaries
 
     def create_utestid(self, row):
         """Creates a utestid instance if one does not already exist."""
@@ -0,0 +1,102 @@
+from datetime import datetime
+from dateutil.parser import parse
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from .choices import PROCESS_FIELD_DATATYPES
+from .localize import localize
+
+STRING = 'string'
+INTEGER = 'integer'
+DECIMAL = 'decimal'
+DATETIME = 'datetime'
+
+# number of distinct raw datetime strings remembered per datetime converter
+DATETIME_CACHE_SIZE = 4096
+
+
+def to_string(value):
+    return value.strip()
+
+
+def to_decimal(value):
+    """Returns value as a Decimal or, if not a number, as a stripped string."""
+    try:
+        return Decimal(value)
+    except (InvalidOperation, ValueError):
+        return value.strip()
+
+
+def to_int(value):
+    """Returns value as an int or, if not an integer, as a Decimal or stripped string."""
+    try:
+        return int(value)
+    except ValueError:
+        return to_decimal(value)
+
+
+def to_datetime(value):
+    """Returns value as a localized datetime or, if not a date, as a stripped string."""
+    try:
+        return localize(parse(value))
+    except (OverflowError, ValueError):
+        return value.strip()
+
+
+def make_datetime_converter(datetime_formats=None, maxsize=None):
+    """Returns a memoised datetime converter.
+
+    The converter tries each strptime format in datetime_formats before
+    falling back to :func:`to_datetime`. Results, already localized, are cached
+    on the raw string since analyzer files repeat the same dates on many rows."""
+    datetime_formats = tuple(datetime_formats or [])
+
+    @lru_cache(maxsize=maxsize or DATETIME_CACHE_SIZE)
+    def to_datetime_cached(value):
+        stripped = value.strip()
+        for datetime_format in datetime_formats:
+            try:
+                return localize(datetime.strptime(stripped, datetime_format))
+            except ValueError:
+                pass
+        return to_datetime(value)
+    return to_datetime_cached
+
+
+CONVERTERS = {
+    STRING: to_string,
+    INTEGER: to_int,
+    DECIMAL: to_decimal,
+    DATETIME: to_datetime,
+}
+
+DATATYPE_ALIASES = {
+    'int': INTEGER,
+    'integer': INTEGER,
+    'decimal': DECIMAL,
+    'float': DECIMAL,
+    'numeric': DECIMAL,
+    'date': DATETIME,
+    'datetime': DATETIME,
+    'string': STRING,
+    'text': STRING,
+    'char': STRING,
+}
+
+
+def get_datatype(processing_field=None, value_datatype=None):
+    """Returns the datatype of a column mapped either to a processing field or to
+    a utestid with value_datatype.
+
+    Utestid values of an unknown datatype are treated as decimals."""
+    if processing_field:
+        return PROCESS_FIELD_DATATYPES.get(processing_field, STRING)
+    return DATATYPE_ALIASES.get((value_datatype or '').lower(), DECIMAL)
+
+
+def get_converter(datatype, datetime_formats=None):
+    """Returns the converter for datatype. Datetime converters are new,
+    memoised instances, see :func:`make_datetime_converter`."""
+    if datatype == DATETIME:
+        return make_datetime_converter(datetime_formats)
+    return CONVERTERS[datatype]
@@ -1,35 +1,88 @@
-from datetime import datetime
+import copy
+import os
+
+from django.db import transaction
 from django.utils import timezone
-from fnmatch import filter
-from os import listdir
+from fnmatch import fnmatch
 from os.path import join
-from shutil import move
 from watchdog.events import PatternMatchingEventHandler
 
 from getresults_csv.exceptions import CsvLoadError
-from getresults_csv.models import CsvFormat, ImportHistory
+from getresults_csv.models import CsvFormat, ImportHistory, ImportedIdentifier
 
+from .archiver import Archiver
+from .checkpoint import clear_checkpoint, get_checkpoint, get_tail_checkpoint, save_checkpoint
 from .csv_result import CsvResult
+from .format_plan import get_format_index
+from .ledger import ImportLedger
+from .polling import compile_patterns
+from .row_diff import RowDiff
+from .scheduler import EventCoalescer
 
 
 class CsvFileHandler(PatternMatchingEventHandler):
+    """Imports the CSV files that match patterns in source_dir.
+
+    A file that is rewritten under the same name (e.g. re-exported after a
+    correction) only has its added or changed rows saved, see RowDiff.
+
+    Files that match tail_patterns are instead expected to be appended to (e.g.
+    by an instrument all day). On each event only the complete lines appended
+    since the last import are read and saved, see tail_file.
+
+    With polling the handler is scheduled on a ScandirPollingObserver, see Server.observe.
+
+    save_handler_factory, if given, is a callable that returns a new save
+    handler like save_handler, see new_save_handler."""
 
     def __init__(self, csv_format, source_dir, archive_dir, patterns=None,
-                 save_handler=None, update_history=None, verbose=None):
-        self.csv_format = CsvFormat.objects.get(name=csv_format)
+                 save_handler=None, update_history=None, verbose=None, batch_size=None,
+                 pipeline=None, quiet_period=None, use_ledger=None, use_checkpoints=None,
+                 tail_patterns=None, use_row_diff=None, polling=None, use_mmap=None,
+                 save_handler_factory=None):
+        if csv_format:
+            self.csv_format = CsvFormat.objects.get(name=csv_format)
+        else:
+            self.csv_format = None
         self.source_dir = source_dir
         self.archive_dir = archive_dir
+        self.archiver = Archiver(archive_dir, output=self.output_to_console) if archive_dir else None
         self.save_handler = save_handler
+        self.save_handler_factory = save_handler_factory
         self.update_history = True if update_history is None else update_history
         self.verbose = True if verbose is None else verbose
         self.archive_filename = None
+        self.batch_size = batch_size or 500
+        self.pipeline = pipeline
+        self.ledger = ImportLedger() if use_ledger or use_ledger is None else None
+        self.use_checkpoints = True if use_checkpoints is None else use_checkpoints
+        self.use_mmap = use_mmap
+        self.use_row_diff = True if use_row_diff is None else use_row_diff
+        self.polling = polling
+        if quiet_period is None:
+            self.coalescer = None
+        else:
+            self.coalescer = EventCoalescer(
+                self.import_file, quiet_period=quiet_period, on_failure=self.import_failed,
+                output=self.output_to_console)
         patterns = ['*.csv'] if patterns is None else patterns
         if not isinstance(patterns, (list, tuple)):
             raise TypeError('patterns must be a list. Got {}.')
-        super(CsvFileHandler, self).__init__(patterns=patterns, ignore_directories=True)
+        self.tail_patterns = list(tail_patterns or [])
+        super(CsvFileHandler, self).__init__(
+            patterns=list(patterns) + self.tail_patterns, ignore_directories=True)
 
     def connect(self):
-        pass
+        if self.coalescer:
+            self.coalescer.start()
+        if self.archiver:
+            self.archiver.start()
+
+    def disconnect(self):
+        if self.coalescer:
+            self.coalescer.stop()
+        if self.archiver:
+            self.archiver.stop()
 
     def output_to_console(self, msg):
         if self.verbose:
@@ -46,14 +99,96 @@ class CsvFileHandler(PatternMatchingEventHandler):
         self.output_to_console('{} waiting ...'.format(timezone.now()))
 
     def process(self, event):
-        """Process files on a file event."""
+        """Process files on a file event.
+
+        If the handler has an EventCoalescer (see quiet_period) the events
+        of a file are merged and the file is imported once it is complete. A
+        moved event or an existing file is taken as complete."""
         try:
             path = event.dest_path
         except AttributeError:
             path = event.src_path
         self.output_to_console('{} {} \'{}\'.'.format(
             timezone.now(), event.event_type, self.get_filename(path)))
-        self.read_csv_files(path)
+        if self.is_tailed(path):
+            self.tail_file(path)
+        elif self.coalescer:
+            self.coalescer.add(path, complete=event.event_type in ['moved', 'exists'])
+        else:
+            self.import_file(path)
+
+    def import_file(self, path):
+        """Imports the file now or, if the handler has an ImportPipeline, queues it.
+
+        Files already imported, according to the ledger, are skipped."""
+        ledger_entry = None
+        if self.ledger:
+            try:
+                ledger_entry = self.ledger.entry(path)
+            except FileNotFoundError:
+                return None
+            if ledger_entry.imported:
+                self.output_to_console('{} skipping \'{}\'. Already imported.'.format(
+                    timezone.now(), self.get_filename(path)))
+                return None
+        if self.pipeline:
+            self.pipeline.submit(self, path, ledger_entry=ledger_entry)
+        else:
+            self.read_csv_files(path, ledger_entry=ledger_entry)
+
+    def import_failed(self, path, error):
+        """Records a file that could not be imported, e.g. by the EventCoalescer
+        after its last attempt."""
+        self.record_failure(path, None, None, '{} failed to import \'{}\'. Got {}'.format(
+            timezone.now(), self.get_filename(path), str(error)))
+
+    def new_save_handler(self):
+        """Returns a save handler that is not shared with other threads, e.g.
+        for a save thread of an ImportPipeline."""
+        if self.save_handler_factory:
+            return self.save_handler_factory()
+        return copy.deepcopy(self.save_handler)
+
+    def is_tailed(self, path):
+        filename = os.path.basename(path)
+        return any(fnmatch(filename, pattern) for pattern in self.tail_patterns)
+
+    def tail_file(self, src_path):
+        """Imports the complete lines appended to a tailed file since the last import.
+
+        The offset, inode and header of each tailed file are kept in its
+        ImportCheckpoint; a truncated or replaced file is read from the start.
+        Tailed files are not archived or recorded in the ledger.
+
+        Each import saves with its own save handler, see new_save_handler, as
+        tail imports run on the observer thread."""
+        csv_format = None
+        csv_result = None
+        save_handler = self.new_save_handler()
+        try:
+            checkpoint = get_tail_checkpoint(src_path)
+            if os.stat(src_path).st_size == checkpoint.offset:
+                return None
+            csv_format = self.get_csv_format(src_path)
+            csv_result = CsvResult(
+                csv_format, src_path, save_handler=save_handler, use_mmap=True, complete_only=True,
+                start_offset=checkpoint.offset, start_line=checkpoint.line_num)
+            if not csv_result.use_mmap:
+                raise CsvLoadError('{} cannot tail \'{}\'. Encoding {} is not supported.'.format(
+                    timezone.now(), self.get_filename(src_path), csv_format.encoding))
+            self.save_batches(csv_format, csv_result, src_path, checkpoint=True)
+            if csv_result.offset is not None:
+                save_checkpoint(src_path, csv_result.offset, csv_result.line_num)
+            if len(csv_result):
+                message = '{} loaded {} appended rows of file\'{}\' using CSV format \'{}\'.'.format(
+                    timezone.now(), len(csv_result), self.get_filename(src_path), csv_format.name)
+                self.output_to_console(message)
+                self.record_import(src_path, csv_format, csv_result, message)
+        except FileNotFoundError:
+            return None
+        except CsvLoadError as e:
+            self.record_failure(src_path, csv_format, csv_result, str(e))
+        return csv_result
 
     def on_modified(self, event):
         self.process(event)
@@ -68,50 +203,138 @@ class CsvFileHandler(PatternMatchingEventHandler):
     def on_moved(self, event):
         self.process(event)
 
-    def read_csv_files(self, src_path):
+    def get_csv_format(self, src_path):
+        """Returns the CsvFormat for the file.
+
+        If the handler was not bound to a CsvFormat the file is routed by
+        its header, see FormatIndex. If no format matches, the index is
+        rebuilt once in case the format was just added."""
+        if self.csv_format:
+            return self.csv_format
+        csv_format = get_format_index().route(src_path) or get_format_index(reload=True).route(src_path)
+        if not csv_format:
+            raise CsvLoadError(
+                '{} failed to load \'{}\'. No CSV format matches the header.'.format(
+                    timezone.now(), src_path))
+        return csv_format
+
+    def read_csv_files(self, src_path, parsed_rows=None, ledger_entry=None, save_handler=None):
+        """Imports a file, see also ImportPipeline.
+
+        :param parsed_rows: optional ParsedRows of the file, parsed by worker processes.
+        :param ledger_entry: optional LedgerEntry of the file, see import_file.
+        :param save_handler: optional save handler to use instead of the
+                             handler's own, see new_save_handler."""
         archive_filename = None
+        csv_format = None
+        csv_result = None
+        save_handler = save_handler or self.save_handler
+        if save_handler:
+            save_handler.reset()
+        if self.ledger and not ledger_entry:
+            ledger_entry = self.ledger.entry(src_path)
         try:
-            csv_result = CsvResult(self.csv_format, src_path, save_handler=self.save_handler)
-            csv_result.load()
-            if csv_result.save_handler.error_messages:
-                msg = ','.join(list(set(csv_result.save_handler.error_messages)))
-                raise CsvLoadError(msg)
+            csv_format = self.get_csv_format(src_path)
+            csv_result = self.get_csv_result(csv_format, src_path, parsed_rows, save_handler)
+            row_diff = RowDiff(csv_format.name, src_path) if self.use_row_diff else None
+            self.save_batches(csv_format, csv_result, src_path, row_diff, checkpoint=self.use_checkpoints)
+            if row_diff:
+                row_diff.prune()
             message = '{} loaded file\'{}\' using CSV format \'{}\'.'.format(
-                timezone.now(), self.get_filename(src_path), self.csv_format.name)
+                timezone.now(), self.get_filename(src_path), csv_format.name)
+            if row_diff and row_diff.unchanged:
+                message = '{} Skipped {} unchanged rows.'.format(message, row_diff.unchanged)
             self.output_to_console(message)
-            csv_result.save()
             self.output_to_console('{} saved data for file \'{}\'.'.format(
                 timezone.now(), self.get_filename(src_path)))
             if self.archive_dir:
-                archive_filename = self.move_to_archive(src_path)
-            if self.update_history:
-                ImportHistory.objects.create(
+                archive_filename = self.move_to_archive(
+                    src_path, content_hash=ledger_entry.content_hash if ledger_entry else None)
+            self.record_import(src_path, csv_format, csv_result, message, archive_filename)
+            if ledger_entry:
+                self.ledger.record(
+                    ledger_entry,
+                    archive_filename=archive_filename,
+                    record_count=len(csv_result),
+                    description=csv_result.description)
+            if self.use_checkpoints:
+                clear_checkpoint(src_path)
+        except CsvLoadError as e:
+            self.record_failure(src_path, csv_format, csv_result, str(e))
+        return csv_result
+
+    def record_import(self, src_path, csv_format, csv_result, message, archive_filename=None):
+        """Records a successful import in ImportHistory and ImportedIdentifier."""
+        if self.update_history:
+            with transaction.atomic():
+                import_history = ImportHistory.objects.create(
                     success=True,
                     source=self.get_filename(src_path),
-                    result_identifiers=','.join(csv_result.results.keys() or []),
+                    csv_format=csv_format.name,
                     archive=archive_filename,
                     description=csv_result.description,
                     message=message,
                     record_count=len(csv_result)
                 )
-        except CsvLoadError as e:
-            message = str(e)
-            self.output_to_console(message)
-            if self.update_history:
-                ImportHistory.objects.create(
-                    success=False,
-                    source=self.get_filename(src_path),
-                    description=csv_result.description,
-                    message='{}{}'.format(message, ','.join(list(set(csv_result.save_handler.error_messages))))
-                )
-        return csv_result
+                ImportedIdentifier.objects.bulk_record(import_history, csv_result.identifiers)
+
+    def record_failure(self, src_path, csv_format, csv_result, message):
+        self.output_to_console(message)
+        if self.update_history:
+            save_handler = csv_result.save_handler if csv_result else self.save_handler
+            error_messages = save_handler.error_messages if save_handler else []
+            ImportHistory.objects.create(
+                success=False,
+                source=self.get_filename(src_path),
+                csv_format=csv_format.name if csv_format else None,
+                description=csv_result.description if csv_result else None,
+                message='{}{}'.format(message, ','.join(list(set(error_messages))))
+            )
+
+    def get_csv_result(self, csv_format, src_path, parsed_rows=None, save_handler=None):
+        """Returns the CsvResult of the file.
+
+        With checkpoints an import that was interrupted resumes after the
+        last saved batch, see checkpoint.py. With use_mmap the file is read
+        through a memory map and resumes from the byte offset of that batch,
+        otherwise the rows up to its line are read again and skipped."""
+        save_handler = save_handler or self.save_handler
+        if parsed_rows is not None:
+            return CsvResult(csv_format, src_path, save_handler=save_handler, rows=parsed_rows)
+        checkpoint = get_checkpoint(src_path) if self.use_checkpoints else None
+        if checkpoint:
+            self.output_to_console('{} resuming \'{}\' from line {}.'.format(
+                timezone.now(), self.get_filename(src_path), checkpoint.line_num))
+        return CsvResult(
+            csv_format, src_path, save_handler=save_handler,
+            use_mmap=self.use_mmap,
+            start_offset=checkpoint.offset if checkpoint else None,
+            start_line=checkpoint.line_num if checkpoint else None)
+
+    def save_batches(self, csv_format, csv_result, src_path, row_diff=None, checkpoint=None):
+        """Saves the file in batches, with checkpoint recording a checkpoint after each batch.
+
+        With a RowDiff only the rows added or changed since the file was last
+        imported are passed to the save handler."""
+        for items in csv_result.iter_batches(self.batch_size):
+            if row_diff:
+                items = row_diff.changed(items)
+            if items:
+                csv_result.save_handler.save_batch(csv_format, items)
+            if csv_result.save_handler.error_messages:
+                msg = ','.join(list(set(csv_result.save_handler.error_messages)))
+                raise CsvLoadError(msg)
+            if row_diff:
+                row_diff.commit()
+            if checkpoint:
+                save_checkpoint(src_path, csv_result.offset, csv_result.line_num)
 
-    def move_to_archive(self, src_path):
+    def move_to_archive(self, src_path, content_hash=None):
+        """Moves the file out of the source folder and returns its path in the
+        archive, see Archiver. The file is compressed in the background while the
+        handler is connected."""
         filename = self.get_filename(src_path)
-        timestamp = datetime.now().strftime('%Y%m%d%H%m%s')
-        src = join(self.source_dir, filename)
-        dst = join(self.archive_dir, '{}.{}'.format(filename, timestamp))
-        move(src, dst)
+        dst = self.archiver.archive(join(self.source_dir, filename), content_hash=content_hash)
         self.output_to_console(
             '{} moved file \'{}\' to archive'.format(timezone.now(), filename))
         return dst
@@ -121,6 +344,10 @@ class CsvFileHandler(PatternMatchingEventHandler):
 
     @property
     def matching_files(self):
-        for file_pattern in self.patterns:
-            for file in filter(listdir(self.source_dir), file_pattern):
-                yield join(self.source_dir, file)
+        """Yields the files in source_dir that match any of the patterns, in one scandir pass."""
+        pattern = compile_patterns(self.patterns)
+        if not pattern:
+            return
+        for entry in os.scandir(self.source_dir):
+            if pattern.match(entry.name) and entry.is_file():
+                yield entry.path
@@ -1,28 +1,56 @@
 import csv
 import os
-import re
 
 from collections import OrderedDict
-from dateutil.parser import parse
-from decimal import Decimal, InvalidOperation
 from django.utils import timezone
 
 from .choices import PROCESS_FIELDS
 from .exceptions import CsvLoadError
-from .localize import localize
-from .models import CsvDictionary
-from getresults_csv.exceptions import CsvDictionaryError
+from .format_plan import get_format_plan
+from .mmap_reader import is_ascii_compatible, iter_byte_lines, open_mmap
+from .tokenizer import simple_split_reader, split_line
+from .vectorised import ColumnDecoder
 
 
 class BaseSaveHandler(object):
 
+    # regular expressions of order identifiers to skip, added to those of the
+    # csv format, see FormatPlan.get_row_filter
+    identifier_exclude_patterns = []
+
     def __init__(self):
         self.error_messages = []
 
+    def reset(self):
+        """Clears the error messages of the previous file, see CsvFileHandler."""
+        self.error_messages = []
+
     def save(self, csv_format, results):
         for order_identifier, csv_result_item in results.items():
             print(order_identifier, csv_result_item.as_list())
 
+    def save_batch(self, csv_format, items):
+        """Saves a batch (a CsvResultBatch or list) of CsvResultItems.
+
+        Called repeatedly with fixed-size batches while a file is still being
+        read, see :meth:`CsvResult.iter_batches`. By default passes the batch
+        to :meth:`save`, override if the handler can do better with a list."""
+        results = OrderedDict()
+        for csv_result_item in items:
+            results[str(csv_result_item.order_identifier)] = csv_result_item
+        self.save(csv_format, results)
+
+
+class CsvResultSchema(object):
+    """The field labels and source shared by all CsvResultItems of one file."""
+
+    def __init__(self, field_labels, source):
+        self.field_list = list(field_labels)
+        self.positions = {field_label: index for index, field_label in enumerate(self.field_list)}
+        self.source = source
+        self.required_attrs = [x[0] for x in PROCESS_FIELDS]
+        self.missing_attrs = [k for k in self.required_attrs if k not in self.positions]
+
 
 class CsvResultItem(object):
     """A simple class that represents one result from the CSV file by commonly
@@ -31,64 +59,129 @@ class CsvResultItem(object):
     The CsvDictionary for this csv_format maps a CSV field to the correct
     instance attribute. CsvDictionary "processing fields" map to required instance
     attributes that are common to all csv_result_items while utestid fields
-    are specific to the sender panel. See CsvDictionary."""
+    are specific to the sender panel. See CsvDictionary.
 
-    def __init__(self, attrs, date_re=None):
-        date_re = date_re or '.'
-        for attr, value in attrs.items():
-            try:
-                value = Decimal(value)
-            except (InvalidOperation, ValueError):
-                try:
-                    pattern = re.compile(date_re)
-                    if re.match(pattern, str(value)):
-                        value = localize(parse(value))
-                except (AttributeError, ValueError):
-                    pass
-            try:
-                setattr(self, attr, value.strip())
-            except AttributeError:
-                setattr(self, attr, value)
+    Values are expected to be already converted, see FormatPlan.decode. The
+    item only holds a tuple of values and a reference to the schema of its
+    file; attributes are looked up through the schema."""
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
         missing_attrs = self.missing_attrs()
         if missing_attrs:
             raise TypeError(
                 'Some required attrs are not defined. Check csv dictionary '
                 'for this files csv format. Missing {}.'.format(missing_attrs))
 
+    def __getattr__(self, attr):
+        if attr in CsvResultItem.__slots__ or attr.startswith('__'):
+            raise AttributeError(attr)
+        try:
+            return self.values[self.schema.positions[attr]]
+        except KeyError:
+            raise AttributeError(
+                '\'{}\' object has no attribute \'{}\''.format(self.__class__.__name__, attr))
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.as_dict())
+
     def missing_attrs(self):
-        """Returns None if all required attrs exist in the instance dictionary."""
-        return [k for k in self.required_attrs if k not in self.as_dict()]
+        """Returns an empty list if all required attrs are defined by the schema."""
+        return self.schema.missing_attrs
 
     @property
     def required_attrs(self):
-        return [x[0] for x in PROCESS_FIELDS]
+        return self.schema.required_attrs
+
+    @property
+    def field_list(self):
+        return self.schema.field_list
+
+    @property
+    def source(self):
+        return self.schema.source
 
     def as_list(self):
-        return [self.__dict__.get(k) for k in self.field_list]
+        return list(self.values)
 
     def as_dict(self):
-        return {k: v for k, v in self.__dict__.items() if k in self.field_list}
+        return dict(zip(self.schema.field_list, self.values))
+
+
+class CsvResultBatch(object):
+    """A batch of rows from one file stored by column.
+
+    Values are kept in one list per field label and shared with a single schema.
+    Iterating the batch yields lightweight CsvResultItems."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = tuple([] for _ in schema.field_list)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        schema = self.schema
+        for values in zip(*self.columns):
+            yield CsvResultItem(schema, values)
+
+    def __getitem__(self, index):
+        return CsvResultItem(self.schema, tuple(column[index] for column in self.columns))
+
+    @classmethod
+    def from_columns(cls, schema, columns):
+        batch = cls(schema)
+        batch.columns = tuple(columns)
+        return batch
+
+    def append(self, values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def column(self, field_label):
+        """Returns the list of values of field_label."""
+        return self.columns[self.schema.positions[field_label]]
 
 
 class CsvResult(object):
+    """The results of one CSV file.
+
+    `line_num` is that of the last row read, so that reading can resume after
+    start_line. With use_mmap the file is read through a memory map, see
+    mmap_reader, and `offset` is that of the last row read, so that reading can
+    resume from start_offset instead. With complete_only a last line without a
+    line ending is not read (see tail mode in CsvFileHandler). Files in an
+    encoding that is not ASCII compatible (e.g. utf_16) are read as text and
+    `offset` stays None.
 
-    def __init__(self, csv_format, filename, save_handler=None):
+    A file that cannot be read (e.g. a csv.Error) raises CsvLoadError."""
+
+    def __init__(self, csv_format, filename, save_handler=None, format_plan=None, rows=None,
+                 identifier_exclude_patterns=None, use_mmap=None, start_offset=None, start_line=None,
+                 complete_only=None):
         self.csv_format = csv_format
         self.filename = os.path.expanduser(filename)
         if save_handler:
             self.save_handler = save_handler
         else:
             self.save_handler = BaseSaveHandler()
-        self.field_labels = []
-        self.csv_fields = []
-        for csv_dictionary in CsvDictionary.objects.filter(csv_format=self.csv_format):
-            self.csv_fields.append(csv_dictionary.csv_field)
-        for csv_dictionary in CsvDictionary.objects.filter(csv_format=self.csv_format):
-            try:
-                self.field_labels.append(csv_dictionary.processing_field)
-            except AttributeError:
-                self.field_labels.append(csv_dictionary.utestid.name)
+        self.format_plan = format_plan or get_format_plan(self.csv_format)
+        self.field_labels = list(self.format_plan.field_labels)
+        self.schema = CsvResultSchema(self.field_labels, self.filename)
+        self.row_filter = self.format_plan.get_row_filter(
+            list(self.save_handler.identifier_exclude_patterns) + list(identifier_exclude_patterns or []))
         self.results = OrderedDict()
+        self.identifiers = OrderedDict()
+        self.rows = rows
+        self.use_mmap = bool(use_mmap) and is_ascii_compatible(self.format_plan.encoding)
+        self.start_offset = start_offset
+        self.offset = None
+        self.line_num = start_line or 1
+        self.complete_only = complete_only
 
     def __repr__(self):
         return '{0}({1}, {2})'.format(
@@ -102,7 +195,7 @@ class CsvResult(object):
             yield csv_result_item
 
     def __len__(self):
-        return len(self.results)
+        return len(self.results or self.identifiers)
 
     @property
     def description(self):
@@ -111,38 +204,170 @@ class CsvResult(object):
 
     def load(self):
         """Loads the CSV file into a dictionary of CsvResultItem instances."""
-        with open(self.filename, 'r', encoding=self.csv_format.encoding, newline='') as f:
+        for csv_result_item in self.iter_items():
+            self.results[str(csv_result_item.order_identifier)] = csv_result_item
+
+    def iter_items(self):
+        """Yields a CsvResultItem for each row of the CSV file as it is read.
+
+        Items are not kept, only the order identifier and line number of each
+        are collected in `identifiers`."""
+        schema = self.schema
+        for values in self.iter_rows():
+            yield CsvResultItem(schema, values)
+
+    def iter_batches(self, batch_size):
+        """Yields CsvResultBatches of at most batch_size rows, see :meth:`iter_items`."""
+        rows = self.iter_rows()
+        batch = CsvResultBatch(self.schema)
+        for values in rows:
+            batch.append(values)
+            if len(batch) == batch_size:
+                yield batch
+                batch = CsvResultBatch(self.schema)
+        if len(batch):
+            yield batch
+
+    def iter_vectorised_batches(self, batch_size):
+        """Yields CsvResultBatches of at most batch_size rows decoded in bulk.
+
+        Only the mapped columns of each line are tokenized and numeric utestid
+        columns are NumPy float64 arrays with NaN for blanks, see ColumnDecoder.
+        Lines are numbered as by the other readers, blank lines included.
+        Requires numpy."""
+        self.identifiers = OrderedDict()
+        if self.schema.missing_attrs:
+            raise TypeError(
+                'Some required attrs are not defined. Check csv dictionary '
+                'for this files csv format. Missing {}.'.format(self.schema.missing_attrs))
+        decoder = ColumnDecoder(self.format_plan)
+        accepts = self.row_filter.accepts if self.row_filter else None
+        order_identifier_index = self.schema.positions['order_identifier']
+        with open(self.filename, 'r', encoding=self.format_plan.encoding, newline='') as f:
             try:
-                reader = csv.reader(f, delimiter=self.csv_format.delimiter)
-                header_row = next(reader)
-                header_row = [h.strip('\t\n\r') for h in header_row]
-                if not self.csv_format.get_header_as_list() == header_row:
-                    raise CsvLoadError(
-                        '{} failed to load \'{}\' using CSV format \'{}\'. '
-                        'Invalid header format.'.format(
-                            timezone.now(), self.filename, self.csv_format.name))
-                csv_dictionaries = CsvDictionary.objects.filter(csv_format=self.csv_format)
-                for row in reader:
-                    attrs = OrderedDict()
-                    field_list = []
-                    row = dict(zip(header_row, row))
-                    for csv_dictionary in csv_dictionaries:
-                        try:
-                            field_label = csv_dictionary.utestid.name
-                        except AttributeError:
-                            field_label = csv_dictionary.processing_field
-                        if not field_label:
-                            raise CsvDictionaryError(
-                                'Csv format \'{}\' field \'{}\' must be mapped to either a processing '
-                                ' field or a utestid. Got None for both.'.format(
-                                    self.csv_format, csv_dictionary.csv_field.name))
-                        attrs.update({field_label: row.get(csv_dictionary.csv_field.name)})
-                        field_list.append(field_label)
-                    attrs.update({'field_list': field_list, 'source': self.filename})
-                    csv_result_item = CsvResultItem(attrs)
-                    self.results[str(csv_result_item.order_identifier)] = csv_result_item
+                self.check_header(next(csv.reader(f, delimiter=self.format_plan.delimiter)))
+                rows = []
+                line_nums = []
+                for self.line_num, row in enumerate(decoder.iter_rows(f), 2):
+                    if accepts and not accepts(row):
+                        continue
+                    rows.append(row)
+                    line_nums.append(self.line_num)
+                    if len(rows) == batch_size:
+                        yield self.decode_batch(decoder, rows, line_nums, order_identifier_index)
+                        rows = []
+                        line_nums = []
+                if rows:
+                    yield self.decode_batch(decoder, rows, line_nums, order_identifier_index)
             except (UnicodeDecodeError, csv.Error) as e:
-                print('Unable to read {}. Got {}'.format(self.filename, str(e)))
+                self.raise_read_error(e)
+
+    def decode_batch(self, decoder, rows, line_nums, order_identifier_index):
+        columns = decoder.decode(rows)
+        for order_identifier, line_num in zip(columns[order_identifier_index], line_nums):
+            self.identifiers[str(order_identifier)] = line_num
+        return CsvResultBatch.from_columns(self.schema, columns)
+
+    def iter_rows(self):
+        """Yields a tuple of converted values, in schema order, for each row of the CSV file.
+
+        Rows rejected by the row filter are skipped before their values are
+        converted. If the rows were already parsed and passed to the constructor
+        as (line_num, values), see pipeline.ParsedRows, these are yielded instead
+        of reading the file; they were filtered when parsed."""
+        self.identifiers = OrderedDict()
+        if self.schema.missing_attrs:
+            raise TypeError(
+                'Some required attrs are not defined. Check csv dictionary '
+                'for this files csv format. Missing {}.'.format(self.schema.missing_attrs))
+        if self.rows is not None:
+            order_identifier_index = self.schema.positions['order_identifier']
+            for self.line_num, values in self.rows:
+                self.identifiers[str(values[order_identifier_index])] = self.line_num
+                yield values
+        elif self.use_mmap:
+            for values in self.iter_mmap_rows():
+                yield values
+        else:
+            for values in self.iter_text_rows():
+                yield values
+
+    def iter_text_rows(self):
+        order_identifier_index = self.schema.positions['order_identifier']
+        with open(self.filename, 'r', encoding=self.format_plan.encoding, newline='') as f:
+            try:
+                if self.format_plan.simple_split:
+                    reader = simple_split_reader(f, self.format_plan.delimiter)
+                else:
+                    reader = csv.reader(f, delimiter=self.format_plan.delimiter)
+                self.check_header(next(reader))
+                decode = self.format_plan.decode
+                accepts = self.row_filter.accepts if self.row_filter else None
+                resume_line = self.line_num
+                for line_num, row in enumerate(reader, 2):
+                    if line_num <= resume_line:
+                        continue
+                    self.line_num = line_num
+                    if accepts and not accepts(row):
+                        continue
+                    values = decode(row)
+                    self.identifiers[str(values[order_identifier_index])] = line_num
+                    yield values
+            except (UnicodeDecodeError, csv.Error) as e:
+                self.raise_read_error(e)
+
+    def iter_mmap_rows(self):
+        """Yields the rows after start_offset, splitting lines on raw bytes and
+        decoding each line only when it is read.
+
+        Without a start_offset the rows up to start_line are skipped."""
+        order_identifier_index = self.schema.positions['order_identifier']
+        encoding = self.format_plan.encoding
+        delimiter = self.format_plan.delimiter
+        byte_delimiter = delimiter.encode(encoding)
+        with open_mmap(self.filename) as buffer:
+            try:
+                lines = iter_byte_lines(buffer, complete_only=self.complete_only, delimiter=byte_delimiter)
+                try:
+                    header_line, header_end = next(lines)
+                except StopIteration:
+                    return
+                self.check_header(split_line(header_line.decode(encoding), delimiter))
+                decode = self.format_plan.decode
+                accepts = self.row_filter.accepts if self.row_filter else None
+                start_offset = max(self.start_offset or 0, header_end)
+                resume_line = 1 if self.start_offset else self.line_num
+                if not self.start_offset:
+                    self.line_num = 1
+                for line, self.offset in iter_byte_lines(
+                        buffer, start_offset, self.complete_only, byte_delimiter):
+                    self.line_num += 1
+                    if self.line_num <= resume_line:
+                        continue
+                    row = split_line(line.decode(encoding), delimiter) if line else []
+                    if accepts and not accepts(row):
+                        continue
+                    values = decode(row)
+                    self.identifiers[str(values[order_identifier_index])] = self.line_num
+                    yield values
+            except (UnicodeDecodeError, csv.Error) as e:
+                self.raise_read_error(e)
+
+    def raise_read_error(self, error):
+        """Raises CsvLoadError so that a file that cannot be read is recorded as
+        a failed import instead of being taken as ending early."""
+        raise CsvLoadError(
+            '{} failed to load \'{}\' using CSV format \'{}\'. Unable to read line {}. Got {}'.format(
+                timezone.now(), self.filename, self.csv_format.name, self.line_num + 1, str(error)))
+
+    def check_header(self, header_row):
+        """Raises CsvLoadError if the header row of the file does not match the format."""
+        header_row = [h.strip('\t\n\r') for h in header_row]
+        if not self.format_plan.matches_header(header_row):
+            raise CsvLoadError(
+                '{} failed to load \'{}\' using CSV format \'{}\'. '
+                'Invalid header format.'.format(
+                    timezone.now(), self.filename, self.csv_format.name))
 
     def save(self):
         self.save_handler.save(self.csv_format, self.results)
@@ -0,0 +1,289 @@
+import hashlib
+import re
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from getresults_order.models import Utestid
+
+from .converters import get_converter, get_datatype
+from .exceptions import CsvDictionaryError, CsvLoadError
+from .models import CsvDictionary, CsvField, CsvFormat
+from .tokenizer import split_line
+
+try:
+    FORMAT_PLAN_TTL = settings.GETRESULTS_CSV_FORMAT_PLAN_TTL
+except AttributeError:
+    FORMAT_PLAN_TTL = 60  # seconds
+
+# bytes read at a time from a file when looking for the end of its header line
+HEADER_READ_SIZE = 65536
+
+FORMAT_PLAN_MODELS = [CsvFormat, CsvField, CsvDictionary, Utestid]
+
+
+class FormatPlan(object):
+    """A compiled, read-only description of how to decode the rows of files
+    of one CsvFormat.
+
+    The plan is built once from the CsvDictionary of the format. Each mapped
+    CSV field is resolved to its column index in the header, to its field label
+    (either the utestid name or the processing field) and to the datatype of its
+    values so that decoding a row is reduced to tuple indexing and one
+    pre-selected conversion per column. A CSV field that is not in the header
+    has no column index and its value is None. Use :func:`get_format_plan` to
+    get a cached plan."""
+
+    def __init__(self, csv_format):
+        self.csv_format_name = csv_format.name
+        self.delimiter = csv_format.delimiter
+        self.encoding = csv_format.encoding
+        self.simple_split = csv_format.simple_split
+        self.header = normalise_header(csv_format.get_header_as_list())
+        self.fingerprint = header_fingerprint(self.header)
+        positions = {name: index for index, name in enumerate(self.header)}
+        columns = []
+        csv_dictionaries = CsvDictionary.objects.filter(
+            csv_format=csv_format).select_related('utestid', 'csv_field')
+        for csv_dictionary in csv_dictionaries:
+            try:
+                field_label = csv_dictionary.utestid.name
+            except AttributeError:
+                field_label = csv_dictionary.processing_field
+            if not field_label:
+                raise CsvDictionaryError(
+                    'Csv format \'{}\' field \'{}\' must be mapped to either a processing '
+                    ' field or a utestid. Got None for both.'.format(
+                        csv_format, csv_dictionary.csv_field.name))
+            index = positions.get(csv_dictionary.csv_field.name)  # None if not in the header
+            try:
+                datatype = get_datatype(value_datatype=csv_dictionary.utestid.value_datatype)
+            except AttributeError:
+                datatype = get_datatype(processing_field=csv_dictionary.processing_field)
+            columns.append((index, field_label, datatype))
+        self.columns = tuple(columns)
+        self.field_labels = tuple(field_label for _, field_label, _ in self.columns)
+        self.datetime_formats = tuple(csv_format.get_datetime_formats())
+        self.converters = self.get_converters()
+        raw_indexes = {field_label: index for index, field_label, _ in self.columns}
+        self.identifier_index = raw_indexes.get('order_identifier')
+        self.sender_panel_index = raw_indexes.get('sender_panel')
+        self.identifier_exclude_patterns = tuple(csv_format.get_identifier_exclude_patterns())
+        self.panel_allow_list = frozenset(csv_format.get_panel_allow_list())
+        self.skip_blank_rows = csv_format.skip_blank_rows
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.csv_format_name)
+
+    def __getstate__(self):
+        """Excludes the (memoised) converters so the plan can be sent to a worker process."""
+        state = self.__dict__.copy()
+        del state['converters']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.converters = self.get_converters()
+
+    def get_converters(self):
+        """Returns a tuple of (column index, converter) in field_label order."""
+        converters = {
+            datatype: get_converter(datatype, self.datetime_formats)
+            for datatype in set(datatype for _, _, datatype in self.columns)}
+        return tuple((index, converters[datatype]) for index, _, datatype in self.columns)
+
+    def get_row_filter(self, identifier_exclude_patterns=None):
+        """Returns the RowFilter of the format with identifier_exclude_patterns
+        (e.g. those of the save handler) added to the format's own."""
+        return RowFilter(
+            self.identifier_index,
+            self.sender_panel_index,
+            list(self.identifier_exclude_patterns) + list(identifier_exclude_patterns or []),
+            self.panel_allow_list,
+            self.skip_blank_rows)
+
+    def matches_header(self, header_row):
+        """Returns True if the header_row read from a file matches the format's header."""
+        return self.header == normalise_header(header_row)
+
+    def decode(self, row):
+        """Returns the converted values of a tokenized row in field_label order."""
+        length = len(row)
+        return tuple(
+            convert(row[index]) if index is not None and index < length else None
+            for index, convert in self.converters)
+
+
+class RowFilter(object):
+    """Decides from the raw tokens of a row, before any value is converted,
+    whether the row is imported.
+
+    A row is skipped if it is blank (with skip_blank_rows), if its order identifier
+    matches one of the exclude patterns or if its sender panel is not in the
+    panel allow list (when one is given). The exclude patterns are compiled into
+    a single alternation matched from the start of the identifier, like re.match."""
+
+    def __init__(self, identifier_index, sender_panel_index, identifier_exclude_patterns=None,
+                 panel_allow_list=None, skip_blank_rows=None):
+        self.identifier_index = identifier_index
+        self.sender_panel_index = sender_panel_index
+        self.exclude = compile_alternation(identifier_exclude_patterns)
+        self.panel_allow_list = frozenset(panel_allow_list or [])
+        self.skip_blank_rows = skip_blank_rows
+        if self.identifier_index is None:
+            self.exclude = None
+        if self.sender_panel_index is None:
+            self.panel_allow_list = frozenset()
+
+    def __bool__(self):
+        return bool(self.exclude or self.panel_allow_list or self.skip_blank_rows)
+
+    def accepts(self, row):
+        """Returns False if the tokenized row is to be skipped."""
+        if self.skip_blank_rows and not any(value.strip() for value in row):
+            return False
+        length = len(row)
+        if self.exclude and self.identifier_index < length:
+            if self.exclude.match(row[self.identifier_index].strip()):
+                return False
+        if self.panel_allow_list:
+            if self.sender_panel_index >= length:
+                return False
+            if row[self.sender_panel_index].strip() not in self.panel_allow_list:
+                return False
+        return True
+
+
+class FormatIndex(object):
+    """An index of CsvFormats by the fingerprint of their header.
+
+    Routes a file to its CsvFormat by reading only the header line of the file,
+    tokenizing it once for each distinct encoding and delimiter of the indexed
+    formats and looking up its fingerprint. Use :func:`get_format_index` to get
+    a cached index of all formats."""
+
+    def __init__(self, csv_formats=None):
+        csv_formats = CsvFormat.objects.all() if csv_formats is None else csv_formats
+        self.csv_formats = {}
+        self.dialects = []
+        for csv_format in csv_formats:
+            header = csv_format.get_header_as_list()
+            if not header:
+                continue
+            self.csv_formats[header_fingerprint(header)] = csv_format
+            dialect = (csv_format.encoding, csv_format.delimiter)
+            if dialect not in self.dialects:
+                self.dialects.append(dialect)
+
+    def __len__(self):
+        return len(self.csv_formats)
+
+    def route(self, filename):
+        """Returns the CsvFormat whose header matches the header of the file or None."""
+        raw_header = read_raw_header(filename)
+        for encoding, delimiter in self.dialects:
+            try:
+                line = raw_header.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                continue
+            try:
+                csv_format = self.csv_formats[header_fingerprint(split_line(line, delimiter))]
+            except KeyError:
+                continue
+            return csv_format
+        return None
+
+
+def compile_alternation(patterns):
+    """Returns one compiled regex matching any of patterns, or None if there are none.
+
+    Raises CsvLoadError if a pattern is not a valid regular expression."""
+    patterns = [getattr(pattern, 'pattern', pattern) for pattern in patterns or []]
+    if not patterns:
+        return None
+    for pattern in patterns:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise CsvLoadError('Invalid identifier exclude pattern \'{}\'. Got {}'.format(pattern, str(e)))
+    return re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns))
+
+
+def normalise_header(header_row):
+    return tuple(h.strip('\t\n\r') for h in header_row)
+
+
+def header_fingerprint(header_row):
+    """Returns a hash of the normalised header row."""
+    return hashlib.sha1('\x1f'.join(normalise_header(header_row)).encode('utf-8')).hexdigest()
+
+
+def read_raw_header(filename):
+    """Returns the bytes of the first line of a file without the line ending."""
+    raw_header = b''
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(HEADER_READ_SIZE)
+            raw_header += data
+            for line_ending in [b'\r', b'\n']:
+                position = raw_header.find(line_ending)
+                if position >= 0:
+                    raw_header = raw_header[:position]
+            if len(data) < HEADER_READ_SIZE or b'\r' in data or b'\n' in data:
+                break
+    return raw_header
+
+
+# plans and indexes are cleared when the models they are built from are saved or
+# deleted in this process and are rebuilt after FORMAT_PLAN_TTL seconds to pick
+# up changes made by other processes, e.g. the admin
+_plans = {}
+_indexes = {}
+
+
+def is_current(cached):
+    return cached is not None and time.time() - cached[0] < FORMAT_PLAN_TTL
+
+
+def get_format_plan(csv_format):
+    """Returns the cached FormatPlan for csv_format, building it on first use.
+
+    An expired plan is rebuilt from the CsvFormat as it is now in the database."""
+    cached = _plans.get(csv_format.pk)
+    if is_current(cached):
+        return cached[1]
+    if cached is not None:
+        csv_format = CsvFormat.objects.get(pk=csv_format.pk)
+    plan = FormatPlan(csv_format)
+    _plans[csv_format.pk] = (time.time(), plan)
+    return plan
+
+
+def get_format_index(reload=None):
+    """Returns the cached FormatIndex of all CsvFormats, rebuilt if it expired
+    or with reload, e.g. when no format matched a file."""
+    cached = _indexes.get('all')
+    if not reload and is_current(cached):
+        return cached[1]
+    format_index = FormatIndex()
+    _indexes['all'] = (time.time(), format_index)
+    return format_index
+
+
+def clear_format_plans():
+    _plans.clear()
+    _indexes.clear()
+
+
+@receiver(post_save, weak=False, dispatch_uid='format_plan_on_post_save')
+def format_plan_on_post_save(sender, instance, raw, created, using, update_fields, **kwargs):
+    if sender in FORMAT_PLAN_MODELS:
+        clear_format_plans()
+
+
+@receiver(post_delete, weak=False, dispatch_uid='format_plan_on_post_delete')
+def format_plan_on_post_delete(sender, instance, using, **kwargs):
+    if sender in FORMAT_PLAN_MODELS:
+        clear_format_plans()
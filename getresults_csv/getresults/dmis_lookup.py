@@ -0,0 +1,102 @@
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    DMIS_LOOKUP_TTL = settings.GETRESULTS_CSV_DMIS_LOOKUP_TTL
+except AttributeError:
+    DMIS_LOOKUP_TTL = 3600  # seconds to remember a receive
+
+try:
+    DMIS_LOOKUP_MISS_TTL = settings.GETRESULTS_CSV_DMIS_LOOKUP_MISS_TTL
+except AttributeError:
+    DMIS_LOOKUP_MISS_TTL = 300  # seconds to remember "not received yet"
+
+# SQL Server accepts at most 2100 parameters per query
+DMIS_LOOKUP_CHUNK_SIZE = 1000
+DMIS_LOOKUP_MAXSIZE = 100000
+
+
+class DmisReceiveLookup(object):
+    """Looks up DMIS receives by receive identifier in batches.
+
+    Identifiers not in the cache are fetched with chunked IN queries.
+    Receives found are cached for ttl seconds and identifiers not found
+    ("not received yet") for miss_ttl seconds. `metrics` holds totals and
+    `last_metrics` the counts of the last call to :meth:`get_many`.
+
+    The model and database alias can be given, e.g. to test against a local
+    SQLite stand-in for the 'dmis' alias.
+    """
+
+    def __init__(self, model, using=None, field_name=None, chunk_size=None,
+                 ttl=None, miss_ttl=None, maxsize=None):
+        self.model = model
+        self.using = using
+        self.field_name = field_name or 'receive_identifier'
+        self.chunk_size = chunk_size or DMIS_LOOKUP_CHUNK_SIZE
+        self.ttl = DMIS_LOOKUP_TTL if ttl is None else ttl
+        self.miss_ttl = DMIS_LOOKUP_MISS_TTL if miss_ttl is None else miss_ttl
+        self.maxsize = maxsize or DMIS_LOOKUP_MAXSIZE
+        self.cache = OrderedDict()
+        self.metrics = self.new_metrics()
+        self.last_metrics = self.new_metrics()
+
+    def new_metrics(self):
+        return dict(lookups=0, cache_hits=0, queries=0, found=0, not_found=0, seconds=0.0)
+
+    def get(self, identifier):
+        """Returns the receive or None if not received."""
+        return self.get_many([identifier])[identifier]
+
+    def get_many(self, identifiers):
+        """Returns a dictionary of {identifier: receive or None}."""
+        started = time.time()
+        metrics = self.new_metrics()
+        receives = {}
+        missing = []
+        for identifier in identifiers:
+            metrics['lookups'] += 1
+            try:
+                expires, receive = self.cache[identifier]
+            except KeyError:
+                missing.append(identifier)
+                continue
+            if expires < started:
+                del self.cache[identifier]
+                missing.append(identifier)
+            else:
+                metrics['cache_hits'] += 1
+                receives[identifier] = receive
+        missing = list(OrderedDict.fromkeys(missing))
+        for index in range(0, len(missing), self.chunk_size):
+            chunk = missing[index:index + self.chunk_size]
+            metrics['queries'] += 1
+            found = {getattr(receive, self.field_name): receive
+                     for receive in self.queryset().filter(**{'{}__in'.format(self.field_name): chunk})}
+            for identifier in chunk:
+                receive = found.get(identifier)
+                metrics['found' if receive else 'not_found'] += 1
+                self.store(identifier, receive, started)
+                receives[identifier] = receive
+        metrics['seconds'] = time.time() - started
+        self.last_metrics = metrics
+        for key, value in metrics.items():
+            self.metrics[key] += value
+        return receives
+
+    def queryset(self):
+        if self.using:
+            return self.model.objects.using(self.using)
+        return self.model.objects.all()
+
+    def store(self, identifier, receive, now):
+        ttl = self.ttl if receive else self.miss_ttl
+        self.cache[identifier] = (now + ttl, receive)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        self.cache.clear()
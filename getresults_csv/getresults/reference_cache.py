@@ -0,0 +1,113 @@
+import threading
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from getresults_aliquot.models.aliquot_type import AliquotType
+from getresults_order.models import OrderPanel, OrderPanelItem, Utestid
+from getresults_sender.models import SenderPanel
+
+try:
+    REFERENCE_CACHE_TTL = settings.GETRESULTS_CSV_REFERENCE_CACHE_TTL
+except AttributeError:
+    REFERENCE_CACHE_TTL = 300  # seconds
+
+REFERENCE_MODELS = [AliquotType, OrderPanel, OrderPanelItem, SenderPanel, Utestid]
+
+
+class ReferenceData(object):
+    """One load of the reference data, replaced as a whole by ReferenceCache."""
+
+    def __init__(self):
+        self.sender_panels = {
+            sender_panel.name: sender_panel
+            for sender_panel in SenderPanel.objects.select_related('order_panel')}
+        order_panel_items = defaultdict(list)
+        for order_panel_item in OrderPanelItem.objects.select_related('utestid'):
+            order_panel_items[order_panel_item.order_panel_id].append(order_panel_item)
+        self.order_panel_items = dict(order_panel_items)
+        self.aliquot_types = {
+            aliquot_type.alpha_code: aliquot_type
+            for aliquot_type in AliquotType.objects.all()}
+        self.loaded = time.time()
+
+
+class ReferenceCache(object):
+    """An in-process cache of the reference data used when saving results.
+
+    SenderPanels, OrderPanelItems (with their utestids) and AliquotTypes
+    are loaded together on first use and then served from dictionaries. The cache
+    is cleared when any of these models is saved or deleted in this process
+    and reloaded after ttl seconds to pick up changes made by other processes.
+    A name that is not found reloads the cache once before DoesNotExist is
+    raised, so that e.g. a SenderPanel just added in the admin is found.
+
+    Each load is a new ReferenceData that replaces the previous one in a
+    single assignment, so threads never see a partly loaded cache."""
+
+    def __init__(self, ttl=None):
+        self.ttl = REFERENCE_CACHE_TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.data = None
+
+    def clear(self):
+        self.data = None
+
+    @property
+    def loaded(self):
+        data = self.data
+        return data.loaded if data else None
+
+    def is_current(self, data, stale=None):
+        return data is not None and data is not stale and time.time() - data.loaded < self.ttl
+
+    def load(self, stale=None):
+        """Returns the current ReferenceData, loading it if there is none, it
+        expired or it is the stale one."""
+        data = self.data
+        if self.is_current(data, stale):
+            return data
+        with self.lock:
+            data = self.data
+            if not self.is_current(data, stale):
+                data = self.data = ReferenceData()
+        return data
+
+    def lookup(self, attr, key, model):
+        data = self.load()
+        try:
+            return getattr(data, attr)[key]
+        except KeyError:
+            data = self.load(stale=data)
+        try:
+            return getattr(data, attr)[key]
+        except KeyError:
+            raise model.DoesNotExist('{} matching query does not exist.'.format(model.__name__))
+
+    def get_sender_panel(self, name):
+        return self.lookup('sender_panels', name, SenderPanel)
+
+    def get_order_panel_items(self, order_panel):
+        return self.load().order_panel_items.get(order_panel.pk, [])
+
+    def get_aliquot_type(self, alpha_code):
+        return self.lookup('aliquot_types', alpha_code, AliquotType)
+
+
+reference_cache = ReferenceCache()
+
+
+@receiver(post_save, weak=False, dispatch_uid='reference_cache_on_post_save')
+def reference_cache_on_post_save(sender, instance, raw, created, using, update_fields, **kwargs):
+    if sender in REFERENCE_MODELS:
+        reference_cache.clear()
+
+
+@receiver(post_delete, weak=False, dispatch_uid='reference_cache_on_post_delete')
+def reference_cache_on_post_delete(sender, instance, using, **kwargs):
+    if sender in REFERENCE_MODELS:
+        reference_cache.clear()
@@ -0,0 +1,92 @@
+from django.db import IntegrityError, transaction
+
+from getresults_aliquot.models import Aliquot
+from getresults_aliquot.models.aliquot_type import AliquotType
+from getresults_order.models import Order
+from getresults_receive.models import Receive
+
+from .reference_cache import reference_cache
+
+
+def create_or_get(model, create_kwargs, get_kwargs):
+    """Creates an instance or, if a concurrent worker created it first, gets it.
+
+    Relies on the model's unique constraints instead of check-then-insert; the
+    create runs in a savepoint so a conflict does not break the outer transaction."""
+    try:
+        with transaction.atomic():
+            return model.objects.create(**create_kwargs)
+    except IntegrityError:
+        return model.objects.get(**get_kwargs)
+
+
+class OrderResolver(object):
+    """Resolves the Orders of many order identifiers at once, creating the
+    missing Order, Receive and Aliquot instances.
+
+    Existing instances are fetched with one IN query per model. Missing
+    instances are created one at a time with :func:`create_or_get` since these
+    models set their identifiers in save(), which bulk_create would skip.
+    Once an order exists only the Order query is needed."""
+
+    def __init__(self, alpha_code=None, numeric_code=None):
+        self.alpha_code = alpha_code or 'WB'
+        self.numeric_code = numeric_code or '02'
+        self.aliquot_type = None
+
+    def get_aliquot_type(self):
+        if not self.aliquot_type:
+            try:
+                self.aliquot_type = reference_cache.get_aliquot_type(self.alpha_code)
+            except AliquotType.DoesNotExist:
+                self.aliquot_type = create_or_get(
+                    AliquotType,
+                    dict(alpha_code=self.alpha_code, numeric_code=self.numeric_code),
+                    dict(alpha_code=self.alpha_code))
+        return self.aliquot_type
+
+    def resolve(self, requests):
+        """Returns a dictionary of {order_identifier: order}.
+
+        :param requests: a dictionary of {order_identifier: (collection_date, order_panel)}."""
+        order_identifiers = list(requests)
+        orders = {
+            order.order_identifier: order
+            for order in Order.objects.filter(order_identifier__in=order_identifiers)}
+        missing = [order_identifier for order_identifier in order_identifiers if order_identifier not in orders]
+        if missing:
+            orders.update(self.create_orders(missing, requests))
+        return orders
+
+    def create_orders(self, order_identifiers, requests):
+        receives = {
+            receive.receive_identifier: receive
+            for receive in Receive.objects.filter(receive_identifier__in=order_identifiers)}
+        aliquots = {
+            aliquot.receive_identifier: aliquot
+            for aliquot in Aliquot.objects.filter(receive_identifier__in=order_identifiers)}
+        orders = {}
+        for order_identifier in order_identifiers:
+            collection_date, order_panel = requests[order_identifier]
+            try:
+                receive = receives[order_identifier]
+            except KeyError:
+                receive = create_or_get(
+                    Receive,
+                    dict(receive_identifier=order_identifier, collection_datetime=collection_date),
+                    dict(receive_identifier=order_identifier))
+            try:
+                aliquot = aliquots[order_identifier]
+            except KeyError:
+                aliquot = create_or_get(
+                    Aliquot,
+                    dict(receive=receive, aliquot_type=self.get_aliquot_type()),
+                    dict(receive_identifier=order_identifier))
+            orders[order_identifier] = create_or_get(
+                Order,
+                dict(order_identifier=order_identifier,
+                     order_datetime=collection_date,
+                     order_panel=order_panel,
+                     aliquot=aliquot),
+                dict(order_identifier=order_identifier))
+        return orders
@@ -1,31 +1,39 @@
-import re
-from copy import copy
+from collections import OrderedDict
+from uuid import uuid4
+
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
 from dmis_models.models import Receive as DmisReceive
-from getresults_aliquot.models import Aliquot
-from getresults_aliquot.models.aliquot_type import AliquotType
-from getresults_order.models import Order, OrderPanelItem
-from getresults_receive.models import Receive
 from getresults_result.models import Result, ResultItem
 from getresults_sender.models import SenderPanel
 from django.db.utils import OperationalError
 from getresults_csv.csv_result import BaseSaveHandler
+from getresults_csv.format_plan import compile_alternation
+
+from .dmis_lookup import DmisReceiveLookup
+from .reference_cache import reference_cache
+from .resolvers import OrderResolver
 
 
 class Multiset2DMISSaveHandler(BaseSaveHandler):
 
-    """Save multiset CSV data to DMIS."""
+    """Save multiset CSV data to DMIS.
+
+    With bulk=True each batch is saved in one transaction with Result and
+    ResultItem instances written by bulk_create, see :meth:`bulk_save`. Note that
+    bulk_create does not call the models' save() methods."""
 
     identifier_exclude_patterns = [r'^[0-9]{6}$', r'^[0-9]{5}$']
     file_patterns = [file_ext[0] for file_ext in settings.CSV_FILE_EXT]
 
-    def __init__(self):
+    def __init__(self, bulk=None):
         super(Multiset2DMISSaveHandler, self).__init__()
-        identifier_exclude_patterns = copy(self.identifier_exclude_patterns)
-        for identifier_exclude_pattern in identifier_exclude_patterns:
-            self.identifier_exclude_patterns.append(re.compile(identifier_exclude_pattern))
+        self.bulk = bulk
+        self.order_resolver = OrderResolver()
+        self.dmis_lookup = DmisReceiveLookup(DmisReceive)
+        self.identifier_exclude = compile_alternation(self.identifier_exclude_patterns)
 
     def __str__(self):
         return 'Multiset CSV to DMIS'
@@ -34,49 +42,76 @@ class Multiset2DMISSaveHandler(BaseSaveHandler):
         """Dmis has no "order" prior to result. Sample is tested on the receive
         identifier. so start assume receive identifier and order_identifer are the same."""
         try:
-            receive = DmisReceive.objects.get(receive_identifier=order_identifier)
-        except DmisReceive.DoesNotExist:
-            print('skipping {}. Not received.'.format(order_identifier))
-            receive = None
+            receive = self.dmis_lookup.get(order_identifier)
         except OperationalError as e:
             self.error_messages.append(str(e))
-            receive = None
+            return None
+        if not receive:
+            print('skipping {}. Not received.'.format(order_identifier))
         return receive
 
-    def get_order(self, order_identifier, collection_date, sender_panel):
+    def get_dmis_receives(self, order_identifiers):
+        """Fetches the DMIS receives of a batch into the lookup cache with
+        chunked queries so that :meth:`get_dmis_receive` does not query per row.
+
+        Skipped if a subclass overrides get_dmis_receive."""
+        if type(self).get_dmis_receive is not Multiset2DMISSaveHandler.get_dmis_receive:
+            return
         try:
-            order = Order.objects.get(order_identifier=order_identifier)
-        except Order.DoesNotExist:
-            try:
-                receive = Receive.objects.get(receive_identifier=order_identifier)
-            except Receive.DoesNotExist:
-                receive = Receive.objects.create(
-                    receive_identifier=order_identifier,
-                    collection_datetime=collection_date)
-            try:
-                aliquot_type = AliquotType.objects.get(alpha_code='WB')
-            except AliquotType.DoesNotExist:
-                aliquot_type = AliquotType.objects.create(alpha_code='WB', numeric_code='02')
-            try:
-                aliquot = Aliquot.objects.get(receive_identifier=order_identifier)
-            except Aliquot.DoesNotExist:
-                aliquot = Aliquot.objects.create(
-                    receive=receive,
-                    aliquot_type=aliquot_type)
-            order = Order.objects.create(
-                order_identifier=order_identifier,
-                order_datetime=collection_date,
-                order_panel=sender_panel.order_panel,
-                aliquot=aliquot,
-            )
-        return order
+            self.dmis_lookup.get_many(order_identifiers)
+        except OperationalError as e:
+            self.error_messages.append(str(e))
+
+    def get_receive_identifier(self, order_identifier, csv_result_item):
+        try:
+            dmis_receive = self.get_dmis_receive(order_identifier)
+            receive_identifier = dmis_receive.receive_identifier
+        except AttributeError:
+            receive_identifier = csv_result_item.order_identifier
+        return receive_identifier
+
+    def get_sender_panel(self, name):
+        try:
+            sender_panel = reference_cache.get_sender_panel(name)
+        except SenderPanel.DoesNotExist as e:
+            raise ObjectDoesNotExist('{} Got \'{}\''.format(e, name))
+        return sender_panel
+
+    def get_order(self, order_identifier, collection_date, sender_panel):
+        return self.get_orders(
+            {order_identifier: (collection_date, sender_panel.order_panel)})[order_identifier]
+
+    def get_orders(self, requests):
+        """Returns a dictionary of {order_identifier: order}, see OrderResolver."""
+        return self.order_resolver.resolve(requests)
+
+    def prepare(self, csv_results):
+        """Returns a list of (csv_result_item, sender_panel, order) for the results
+        that are not excluded. The orders of all results are resolved together."""
+        prepared = []
+        requests = OrderedDict()
+        csv_results = OrderedDict(
+            (order_identifier, csv_result_item) for order_identifier, csv_result_item in csv_results.items()
+            if not self.exclude_by_pattern(order_identifier))
+        self.get_dmis_receives(list(csv_results))
+        for order_identifier, csv_result_item in csv_results.items():
+            receive_identifier = str(self.get_receive_identifier(order_identifier, csv_result_item))
+            sender_panel = self.get_sender_panel(csv_result_item.sender_panel)
+            if receive_identifier not in requests:
+                requests[receive_identifier] = (csv_result_item.collection_date, sender_panel.order_panel)
+            prepared.append((csv_result_item, sender_panel, receive_identifier))
+        orders = self.get_orders(requests) if requests else {}
+        return [(csv_result_item, sender_panel, orders[receive_identifier])
+                for csv_result_item, sender_panel, receive_identifier in prepared]
 
     def exclude_by_pattern(self, order_identifier):
-        """Returns True if the order_identifier matches one of the exclude patterns."""
-        for identifier_exclude_pattern in self.identifier_exclude_patterns:
-            if re.match(identifier_exclude_pattern, str(order_identifier)):
-                print('skipping {}'.format(order_identifier))
-                return True
+        """Returns True if the order_identifier matches one of the exclude patterns.
+
+        Rows read by CsvResult are already filtered on the raw identifier, see
+        RowFilter; this covers results passed to the handler directly."""
+        if self.identifier_exclude and self.identifier_exclude.match(str(order_identifier)):
+            print('skipping {}'.format(order_identifier))
+            return True
         return False
 
     def save(self, csv_format, csv_results):
@@ -86,22 +121,7 @@ class Multiset2DMISSaveHandler(BaseSaveHandler):
         # create result, result item
         # result is ready for validation and export to LIS
 
-        for order_identifier, csv_result_item in csv_results.items():
-            if self.exclude_by_pattern(order_identifier):
-                continue
-            try:
-                dmis_receive = self.get_dmis_receive(order_identifier)
-                receive_identifier = dmis_receive.receive_identifier
-            except AttributeError:
-                receive_identifier = csv_result_item.order_identifier
-            try:
-                sender_panel = SenderPanel.objects.get(name=csv_result_item.sender_panel)
-            except SenderPanel.DoesNotExist as e:
-                raise ObjectDoesNotExist('{} Got \'{}\''.format(e, csv_result_item.sender_panel))
-            order = self.get_order(
-                order_identifier=receive_identifier,
-                collection_date=csv_result_item.collection_date,
-                sender_panel=sender_panel)
+        for csv_result_item, sender_panel, order in self.prepare(csv_results):
             result = Result.objects.create(
                 order=order,
                 specimen_identifier=csv_result_item.order_identifier,
@@ -109,7 +129,7 @@ class Multiset2DMISSaveHandler(BaseSaveHandler):
                 analyzer_name=csv_result_item.sender,
                 analyzer_sn=csv_result_item.serial_number,
                 operator=csv_result_item.operator)
-            for order_panel_item in OrderPanelItem.objects.filter(order_panel=sender_panel.order_panel):
+            for order_panel_item in reference_cache.get_order_panel_items(sender_panel.order_panel):
                 try:
                     result = ResultItem.objects.get(
                         result=result,
@@ -131,5 +151,46 @@ class Multiset2DMISSaveHandler(BaseSaveHandler):
                         sender=csv_result_item.sender,
                         source=csv_result_item.source)
 
+    def save_batch(self, csv_format, items):
+        if not self.bulk:
+            return super(Multiset2DMISSaveHandler, self).save_batch(csv_format, items)
+        csv_results = OrderedDict()
+        for csv_result_item in items:
+            csv_results[str(csv_result_item.order_identifier)] = csv_result_item
+        with transaction.atomic():
+            self.bulk_save(csv_format, csv_results)
+
+    def bulk_save(self, csv_format, csv_results):
+        """Saves the results of a batch with one bulk_create each for Result and ResultItem.
+
+        As with :meth:`save` each row gets a new Result, so its result items
+        are always new."""
+        results = []
+        result_items = []
+        for csv_result_item, sender_panel, order in self.prepare(csv_results):
+            result = Result(
+                id=uuid4(),
+                order=order,
+                specimen_identifier=csv_result_item.order_identifier,
+                collection_datetime=csv_result_item.collection_date,
+                analyzer_name=csv_result_item.sender,
+                analyzer_sn=csv_result_item.serial_number,
+                operator=csv_result_item.operator)
+            results.append(result)
+            for order_panel_item in reference_cache.get_order_panel_items(sender_panel.order_panel):
+                value = getattr(csv_result_item, order_panel_item.utestid.name)
+                result_items.append(ResultItem(
+                    result=result,
+                    utestid=order_panel_item.utestid,
+                    value=value,
+                    raw_value=value,
+                    quantifier='=',
+                    result_datetime=csv_result_item.result_datetime,
+                    sender=csv_result_item.sender,
+                    source=csv_result_item.source))
+        Result.objects.bulk_create(results)
+        ResultItem.objects.bulk_create(result_items)
+        return results
+
     def save_to_dmis(self):
         pass
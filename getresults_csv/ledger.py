@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+from collections import namedtuple
+
+from .models import FileImport
+
+# bytes read at a time when hashing a file
+HASH_READ_SIZE = 1024 * 1024
+
+LedgerEntry = namedtuple('LedgerEntry', 'source_filename file_size file_mtime content_hash imported')
+
+
+def content_hash(path):
+    """Returns the sha256 hex digest of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ImportLedger(object):
+    """Keeps track of imported files so that a file is not imported twice.
+
+    Imported files are recorded in FileImport with their name, size, mtime
+    and a hash of their content. The ledger loads these once and then answers
+    from memory: a file with the name, size and mtime of an imported file is
+    not even hashed; otherwise it is imported if its content hash is new."""
+
+    def __init__(self):
+        self.signatures = set()
+        self.content_hashes = set()
+        for source_filename, file_size, file_mtime, file_hash in FileImport.objects.filter(
+                imported=True).values_list('source_filename', 'file_size', 'file_mtime', 'content_hash'):
+            self.signatures.add((source_filename, file_size, file_mtime))
+            if file_hash:
+                self.content_hashes.add(file_hash)
+
+    def __len__(self):
+        return len(self.content_hashes)
+
+    def entry(self, path):
+        """Returns a LedgerEntry for the file, `imported` is True if it was already imported."""
+        stat = os.stat(path)
+        source_filename = os.path.basename(path)
+        signature = (source_filename, stat.st_size, stat.st_mtime)
+        if signature in self.signatures:
+            return LedgerEntry(*signature, content_hash=None, imported=True)
+        file_hash = content_hash(path)
+        return LedgerEntry(*signature, content_hash=file_hash, imported=file_hash in self.content_hashes)
+
+    def record(self, entry, archive_filename=None, record_count=None, description=None):
+        """Records a file as imported."""
+        FileImport.objects.create(
+            source_filename=entry.source_filename,
+            archive_filename=archive_filename,
+            record_count=record_count,
+            imported=True,
+            description=description,
+            content_hash=entry.content_hash,
+            file_size=entry.file_size,
+            file_mtime=entry.file_mtime)
+        self.signatures.add((entry.source_filename, entry.file_size, entry.file_mtime))
+        if entry.content_hash:
+            self.content_hashes.add(entry.content_hash)
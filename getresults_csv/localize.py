@@ -1,7 +1,7 @@
 import pytz
 
 from django.conf import settings
-from django.utils.timezone import make_aware, make_naive
+from django.utils.timezone import is_aware, is_naive, make_aware, make_naive
 
 tz = pytz.timezone(settings.TIME_ZONE)
 
@@ -23,7 +23,8 @@ def localize(value):
         return value
 
     if settings.USE_TZ:
-        value = my_make_aware(value, tz)
-    else:
+        if is_naive(value):
+            value = my_make_aware(value, tz)
+    elif is_aware(value):
         value = my_make_naive(value, tz)
     return value
@@ -0,0 +1,29 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from getresults_csv.archiver import ARCHIVE_RETENTION_DAYS, compact_archive
+
+
+class Command(BaseCommand):
+    args = '<archive_dir>'
+    help = 'Roll the archived files of each day older than --days into one tar bundle per day.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            dest='days',
+            type=int,
+            default=ARCHIVE_RETENTION_DAYS,
+            help='days to keep as single files (default {}).'.format(ARCHIVE_RETENTION_DAYS))
+
+    def handle(self, *args, **options):
+        try:
+            archive_dir = os.path.expanduser(args[0])
+        except IndexError:
+            raise CommandError('Usage: compact_archive {}'.format(self.args))
+        if not os.path.isdir(archive_dir):
+            raise CommandError('Invalid archive folder. Got {}'.format(archive_dir))
+        for bundle in compact_archive(archive_dir, days=options.get('days')):
+            sys.stdout.write('{}\n'.format(bundle))
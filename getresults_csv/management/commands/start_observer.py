@@ -2,38 +2,110 @@ import os
 import socket
 import sys
 
+from functools import partial
 from builtins import ConnectionResetError, ConnectionRefusedError
 from django.core.management.base import BaseCommand, CommandError
 from paramiko import SSHException
 
+from getresults_csv.bindings import make_event_handlers, read_bindings
+from getresults_csv.pipeline import ImportPipeline
 from getresults_csv.server import Server
-from getresults_csv.csv_file_handler import CsvFileHandler
 from getresults_csv.getresults import Multiset2DMISSaveHandler as SaveHandler
 
 
 class Command(BaseCommand):
     args = '<csv_format_name> <source_dir>'
+    help = ('Watch source_dir for CSV files of csv_format_name (or \'auto\'), or '
+            'watch several folders listed in a bindings file with --bindings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bindings',
+            dest='bindings',
+            default=None,
+            help=('a CSV file with columns csv_format, source_dir, patterns, archive_dir. '
+                  'All folders are watched by one observer.'))
+        parser.add_argument(
+            '--parse-workers',
+            dest='parse_workers',
+            type=int,
+            default=None,
+            help='number of processes that parse files. 0 parses on the save threads.')
+        parser.add_argument(
+            '--save-workers',
+            dest='save_workers',
+            type=int,
+            default=None,
+            help=('number of threads that save files to the database. '
+                  'Without it files are imported one at a time.'))
+        parser.add_argument(
+            '--quiet-period',
+            dest='quiet_period',
+            type=float,
+            default=2.0,
+            help=('seconds without events after which a file is checked for completion '
+                  '(default 2.0). Negative imports on every event.'))
+
+        parser.add_argument(
+            '--bulk',
+            dest='bulk',
+            action='store_true',
+            default=False,
+            help='save each batch of results in one transaction using bulk inserts.')
+        parser.add_argument(
+            '--polling',
+            dest='polling',
+            action='store_true',
+            default=False,
+            help=('poll the source folders with os.scandir instead of waiting for file system '
+                  'events, e.g. for network shares. See also the polling column of a bindings file.'))
+        parser.add_argument(
+            '--poll-interval',
+            dest='poll_interval',
+            type=float,
+            default=None,
+            help='seconds between scans of a polled folder (default 5.0).')
+
+    def get_bindings(self, args, options):
+        if options.get('bindings'):
+            try:
+                return read_bindings(options.get('bindings'))
+            except (OSError, ValueError) as e:
+                raise CommandError(str(e))
+        try:
+            return [dict(
+                csv_format=None if args[0] == 'auto' else args[0],
+                source_dir=args[1],
+                patterns=None,
+                archive_dir=os.path.join(args[1], 'archive'))]
+        except IndexError:
+            raise CommandError('Usage: start_observer {} or --bindings <filename>'.format(self.args))
 
     def handle(self, *args, **options):
-        csv_format = args[0]
-        source_dir = args[1]
-        archive_dir = os.path.join(source_dir, 'archive')
-        save_handler = SaveHandler()
-        file_patterns = save_handler.file_patterns
-        event_handler = CsvFileHandler(
-            csv_format=csv_format,
-            source_dir=source_dir,
-            archive_dir=archive_dir,
-            patterns=file_patterns,
-            save_handler=save_handler)
+        bindings = self.get_bindings(args, options)
+        if options.get('save_workers'):
+            pipeline = ImportPipeline(
+                parse_workers=options.get('parse_workers'),
+                save_workers=options.get('save_workers'))
+        else:
+            pipeline = None
+        quiet_period = options.get('quiet_period')
+        event_handlers = make_event_handlers(
+            bindings, partial(SaveHandler, bulk=options.get('bulk')), pipeline=pipeline,
+            quiet_period=None if quiet_period is None or quiet_period < 0 else quiet_period)
         try:
-            server = Server(event_handler)
+            server = Server(event_handlers)
         except (ConnectionResetError, SSHException, ConnectionRefusedError, socket.gaierror) as e:
             raise CommandError(str(e))
         sys.stdout.write('\n' + str(server) + '\n')
-        sys.stdout.write('CSV format: {}\n'.format(server.event_handler.csv_format.name))
-        sys.stdout.write('File patterns: {}\n'.format(','.join([x for x in server.event_handler.patterns])))
-        sys.stdout.write('Source folder: {}\n'.format(server.event_handler.source_dir))
-        sys.stdout.write('Archive folder: {}\n'.format(server.event_handler.archive_dir))
+        for event_handler in server.event_handlers:
+            sys.stdout.write('CSV format: {}\n'.format(event_handler.csv_format or 'auto (by header)'))
+            sys.stdout.write('File patterns: {}\n'.format(','.join([x for x in event_handler.patterns])))
+            sys.stdout.write('Source folder: {}\n'.format(event_handler.source_dir))
+            sys.stdout.write('Archive folder: {}\n'.format(event_handler.archive_dir))
+            if options.get('polling') or event_handler.polling:
+                sys.stdout.write('Polling: yes\n')
+        if pipeline:
+            sys.stdout.write('Pipeline: {}\n'.format(pipeline))
         sys.stdout.write('\npress CTRL-C to stop.\n\n')
-        server.observe()
+        server.observe(polling=options.get('polling'), poll_interval=options.get('poll_interval'))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvformat',
+            name='datetime_formats',
+            field=models.CharField(blank=True, help_text="optional strptime formats of the datetime values, separated by '|'. e.g. %a, %b %d, %Y %I:%M %p|%a, %b %d, %Y", max_length=250, null=True),
+        ),
+    ]
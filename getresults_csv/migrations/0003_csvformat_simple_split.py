@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0002_csvformat_datetime_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvformat',
+            name='simple_split',
+            field=models.BooleanField(default=False, help_text='tokenize lines by splitting on the delimiter. Only lines with a quote character are read with the csv module. Use for files that do not quote values.'),
+        ),
+    ]
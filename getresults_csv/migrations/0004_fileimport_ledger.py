@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0003_csvformat_simple_split'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fileimport',
+            name='source_filename',
+            field=models.CharField(max_length=250),
+        ),
+        migrations.AlterField(
+            model_name='fileimport',
+            name='archive_filename',
+            field=models.CharField(max_length=250, null=True),
+        ),
+        migrations.AddField(
+            model_name='fileimport',
+            name='content_hash',
+            field=models.CharField(db_index=True, help_text='sha256 of the file content', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='fileimport',
+            name='file_size',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='fileimport',
+            name='file_mtime',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='fileimport',
+            index_together=set([('source_filename', 'file_size', 'file_mtime')]),
+        ),
+    ]
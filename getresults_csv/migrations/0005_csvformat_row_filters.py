@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0004_fileimport_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvformat',
+            name='identifier_exclude_patterns',
+            field=models.TextField(blank=True, help_text='optional regular expressions, one per line. Rows whose order identifier matches any of them are skipped. e.g. ^[0-9]{6}$', null=True),
+        ),
+        migrations.AddField(
+            model_name='csvformat',
+            name='panel_allow_list',
+            field=models.CharField(blank=True, help_text="optional sender panel names separated by '|'. If set, rows of other sender panels are skipped.", max_length=250, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvformat',
+            name='skip_blank_rows',
+            field=models.BooleanField(default=True, help_text='skip rows without any values.'),
+        ),
+    ]
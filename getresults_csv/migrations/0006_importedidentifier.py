@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from uuid import uuid4
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+import django_revision.revision_field
+import edc_base.model.fields.hostname_modification_field
+import edc_base.model.fields.userfield
+import edc_base.model.fields.uuid_auto_field
+
+
+def copy_result_identifiers(apps, schema_editor):
+    ImportHistory = apps.get_model('getresults_csv', 'ImportHistory')
+    ImportedIdentifier = apps.get_model('getresults_csv', 'ImportedIdentifier')
+    for import_history in ImportHistory.objects.exclude(result_identifiers__isnull=True).iterator():
+        ImportedIdentifier.objects.bulk_create(
+            [ImportedIdentifier(
+                id=uuid4(),
+                import_history=import_history,
+                order_identifier=order_identifier) for order_identifier in
+             import_history.result_identifiers.split(',') if order_identifier],
+            batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0005_csvformat_row_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedIdentifier',
+            fields=[
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('user_created', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(default='mac2-2.local', editable=False, help_text='System field. (modified on create only)', max_length=50)),
+                ('hostname_modified', edc_base.model.fields.hostname_modification_field.HostnameModificationField(editable=False, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('id', edc_base.model.fields.uuid_auto_field.UUIDAutoField(editable=False, help_text='System field. UUID primary key.', primary_key=True, serialize=False)),
+                ('order_identifier', models.CharField(db_index=True, max_length=50)),
+                ('row_number', models.IntegerField(null=True)),
+                ('import_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='getresults_csv.ImportHistory')),
+            ],
+            options={
+                'ordering': ('import_history', 'row_number'),
+            },
+        ),
+        migrations.RunPython(copy_result_identifiers, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='importhistory',
+            name='result_identifiers',
+        ),
+    ]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from uuid import uuid4
+
+from django.db import migrations, models
+from django.utils import timezone
+import django_extensions.db.fields
+import django_revision.revision_field
+import edc_base.model.fields.hostname_modification_field
+import edc_base.model.fields.userfield
+import edc_base.model.fields.uuid_auto_field
+
+
+def rollup_import_history(apps, schema_editor):
+    ImportHistory = apps.get_model('getresults_csv', 'ImportHistory')
+    ImportRollup = apps.get_model('getresults_csv', 'ImportRollup')
+    totals = defaultdict(lambda: [0, 0, 0])
+    for import_datetime, success, record_count in ImportHistory.objects.values_list(
+            'import_datetime', 'success', 'record_count').iterator():
+        if timezone.is_aware(import_datetime):
+            import_datetime = timezone.localtime(import_datetime)
+        total = totals[import_datetime.date()]
+        total[0] += 1
+        total[1] += record_count or 0
+        total[2] += 0 if success else 1
+    ImportRollup.objects.bulk_create([
+        ImportRollup(
+            id=uuid4(), import_date=import_date, csv_format='', files=files, records=records, failures=failures)
+        for import_date, (files, records, failures) in totals.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0006_importedidentifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importhistory',
+            name='csv_format',
+            field=models.CharField(max_length=25, null=True),
+        ),
+        migrations.AlterField(
+            model_name='importhistory',
+            name='source',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AlterIndexTogether(
+            name='importhistory',
+            index_together=set([('import_datetime', 'success', 'source'), ('import_datetime', 'id')]),
+        ),
+        migrations.CreateModel(
+            name='ImportRollup',
+            fields=[
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('user_created', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(default='mac2-2.local', editable=False, help_text='System field. (modified on create only)', max_length=50)),
+                ('hostname_modified', edc_base.model.fields.hostname_modification_field.HostnameModificationField(editable=False, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('id', edc_base.model.fields.uuid_auto_field.UUIDAutoField(editable=False, help_text='System field. UUID primary key.', primary_key=True, serialize=False)),
+                ('import_date', models.DateField()),
+                ('csv_format', models.CharField(blank=True, default='', max_length=25)),
+                ('files', models.IntegerField(default=0)),
+                ('records', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('-import_date', 'csv_format'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='importrollup',
+            unique_together=set([('import_date', 'csv_format')]),
+        ),
+        migrations.RunPython(rollup_import_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import django_extensions.db.fields
+import django_revision.revision_field
+import edc_base.model.fields.hostname_modification_field
+import edc_base.model.fields.userfield
+import edc_base.model.fields.uuid_auto_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0007_importhistory_indexes_importrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveEntry',
+            fields=[
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('user_created', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(default='mac2-2.local', editable=False, help_text='System field. (modified on create only)', max_length=50)),
+                ('hostname_modified', edc_base.model.fields.hostname_modification_field.HostnameModificationField(editable=False, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('id', edc_base.model.fields.uuid_auto_field.UUIDAutoField(editable=False, help_text='System field. UUID primary key.', primary_key=True, serialize=False)),
+                ('source_filename', models.CharField(db_index=True, max_length=250)),
+                ('content_hash', models.CharField(db_index=True, help_text='sha256 of the file content', max_length=64, null=True)),
+                ('archive_path', models.CharField(max_length=250, unique=True)),
+                ('archive_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('bundle', models.CharField(help_text='the tar bundle holding the archived file after compaction, see compact_archive', max_length=250, null=True)),
+            ],
+            options={
+                'ordering': ('-archive_datetime',),
+            },
+        ),
+        migrations.AlterField(
+            model_name='importhistory',
+            name='archive',
+            field=models.CharField(max_length=250, null=True),
+        ),
+    ]
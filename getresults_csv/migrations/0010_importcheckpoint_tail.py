@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0009_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='inode',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='header_hash',
+            field=models.CharField(help_text='sha1 of the header line of a tailed file', max_length=40, null=True),
+        ),
+    ]
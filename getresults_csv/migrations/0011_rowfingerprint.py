@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django_extensions.db.fields
+import django_revision.revision_field
+import edc_base.model.fields.hostname_modification_field
+import edc_base.model.fields.userfield
+import edc_base.model.fields.uuid_auto_field
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getresults_csv', '0010_importcheckpoint_tail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowFingerprint',
+            fields=[
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('user_created', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model.fields.userfield.UserField(editable=False, max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(default='mac2-2.local', editable=False, help_text='System field. (modified on create only)', max_length=50)),
+                ('hostname_modified', edc_base.model.fields.hostname_modification_field.HostnameModificationField(editable=False, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('id', edc_base.model.fields.uuid_auto_field.UUIDAutoField(editable=False, help_text='System field. UUID primary key.', primary_key=True, serialize=False)),
+                ('source_key', models.CharField(help_text='sha1 of the CSV format name and full path of the file', max_length=40)),
+                ('source_path', models.CharField(max_length=250)),
+                ('order_identifier', models.CharField(max_length=50)),
+                ('values_hash', models.CharField(max_length=40)),
+                ('import_number', models.IntegerField(default=1, help_text='the last import of the file that read the row')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rowfingerprint',
+            unique_together=set([('source_key', 'order_identifier')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='rowfingerprint',
+            index_together=set([('source_key', 'import_number')]),
+        ),
+    ]
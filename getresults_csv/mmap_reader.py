@@ -0,0 +1,73 @@
+import mmap
+
+from contextlib import contextmanager
+
+from .tokenizer import ends_in_quotes
+
+QUOTECHAR = b'"'
+
+# characters that must encode to the same single bytes as in ASCII for lines to be split on raw bytes
+ASCII_SAMPLE = '\r\n\t,;|".'
+
+
+def is_ascii_compatible(encoding):
+    """Returns True if lines of a file in encoding can be split on raw bytes, e.g.
+    utf_8, latin_1 or mac_roman but not utf_16."""
+    try:
+        return ASCII_SAMPLE.encode(encoding) == ASCII_SAMPLE.encode('ascii')
+    except (LookupError, UnicodeError):
+        return False
+
+
+@contextmanager
+def open_mmap(filename):
+    """Yields a read-only memory map of the file, or b'' if the file is empty."""
+    with open(filename, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file cannot be mapped
+            yield b''
+            return
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def iter_byte_lines(buffer, offset=0, complete_only=None, delimiter=b','):
+    """Yields (line, end_offset) for each line of buffer from offset, blank
+    lines included, so that lines are counted as csv.reader counts them.
+
+    Lines end with '\\r', '\\n' or '\\r\\n' and are yielded as bytes without
+    the line ending; end_offset is the offset after the line ending, i.e.
+    where to resume. A line that ends inside a quoted value is joined with
+    the following lines, see tokenizer.ends_in_quotes. With complete_only a last
+    line without a line ending (e.g. one still being written) is not yielded."""
+    end = len(buffer)
+    next_cr = next_lf = -2
+    line_start = pos = offset
+    in_quotes = False
+    while pos < end:
+        # each search runs again only once pos has passed its last match
+        if next_cr != -1 and next_cr < pos:
+            next_cr = buffer.find(b'\r', pos)
+        if next_lf != -1 and next_lf < pos:
+            next_lf = buffer.find(b'\n', pos)
+        if next_cr < 0 and next_lf < 0:
+            if complete_only:
+                return
+            eol = stop = end
+        else:
+            eol = next_lf if next_cr < 0 or 0 <= next_lf < next_cr else next_cr
+            stop = eol + 2 if buffer[eol:eol + 2] == b'\r\n' else eol + 1
+        segment = buffer[pos:eol]
+        if in_quotes or QUOTECHAR in segment:
+            in_quotes = ends_in_quotes(segment, delimiter, in_quotes, QUOTECHAR)
+        pos = stop
+        if in_quotes and stop < end:
+            continue
+        if in_quotes and complete_only:
+            return
+        line = buffer[line_start:eol]
+        line_start = stop
+        yield line, stop
@@ -1,11 +1,15 @@
 import codecs
 import os
 import csv
+import re
 
+from collections import OrderedDict
 from uuid import uuid4
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import F
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -68,16 +72,61 @@ class CsvFormat(BaseUuidModel):
         default='utf-8'
     )
 
+    simple_split = models.BooleanField(
+        default=False,
+        help_text=('tokenize lines by splitting on the delimiter. Only lines with a quote '
+                   'character are read with the csv module. Use for files that do not quote values.')
+    )
+
+    datetime_formats = models.CharField(
+        max_length=250,
+        null=True,
+        blank=True,
+        help_text=('optional strptime formats of the datetime values, separated by \'|\'. '
+                   'e.g. %a, %b %d, %Y %I:%M %p|%a, %b %d, %Y')
+    )
+
+    identifier_exclude_patterns = models.TextField(
+        null=True,
+        blank=True,
+        help_text=('optional regular expressions, one per line. Rows whose order identifier '
+                   'matches any of them are skipped. e.g. ^[0-9]{6}$')
+    )
+
+    panel_allow_list = models.CharField(
+        max_length=250,
+        null=True,
+        blank=True,
+        help_text=('optional sender panel names separated by \'|\'. '
+                   'If set, rows of other sender panels are skipped.')
+    )
+
+    skip_blank_rows = models.BooleanField(
+        default=True,
+        help_text='skip rows without any values.'
+    )
+
     def save(self, *args, **kwargs):
         if self.sample_file:
             self.read_sample_header()
         super(CsvFormat, self).save(*args, **kwargs)
 
+    def clean(self):
+        for pattern in self.get_identifier_exclude_patterns():
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValidationError({
+                    'identifier_exclude_patterns': 'Invalid regular expression \'{}\'. Got {}'.format(
+                        pattern, str(e))})
+
     def __str__(self):
         return self.name
 
     def read_sample_header(self):
-        delimiter = codecs.decode(self.delimiter, 'unicode_escape')
+        delimiter = self.delimiter
+        if '\\' in delimiter:
+            delimiter = codecs.decode(delimiter, 'unicode_escape')
         with open(self.sample_file, 'r', encoding=self.encoding) as f:
             reader = csv.reader(f, delimiter=delimiter)
             header = next(reader)
@@ -90,6 +139,21 @@ class CsvFormat(BaseUuidModel):
             return []
         return [h for h in self.header_string.split('|')]
 
+    def get_datetime_formats(self):
+        if not self.datetime_formats:
+            return []
+        return [f for f in self.datetime_formats.split('|') if f]
+
+    def get_identifier_exclude_patterns(self):
+        if not self.identifier_exclude_patterns:
+            return []
+        return [p.strip() for p in self.identifier_exclude_patterns.splitlines() if p.strip()]
+
+    def get_panel_allow_list(self):
+        if not self.panel_allow_list:
+            return []
+        return [p.strip() for p in self.panel_allow_list.split('|') if p.strip()]
+
     class Meta:
         app_label = 'getresults_csv'
 
@@ -166,42 +230,129 @@ class ExportHistory(BaseUuidModel):
         ordering = ('-export_datetime', )
 
 
+class ImportHistoryManager(models.Manager):
+
+    def for_identifier(self, order_identifier):
+        """Returns the import histories of the files that delivered order_identifier."""
+        return self.filter(importedidentifier__order_identifier=order_identifier).distinct()
+
+
 class ImportHistory(BaseUuidModel):
 
     success = models.BooleanField(default=False)
 
     source = models.CharField(
-        max_length=50)
+        max_length=50,
+        db_index=True)
+
+    csv_format = models.CharField(
+        max_length=25,
+        null=True)
 
     record_count = models.IntegerField(null=True)
 
     import_datetime = models.DateTimeField(
         default=timezone.now)
 
-    result_identifiers = models.TextField(null=True)
-
     archive = models.CharField(
-        max_length=100, null=True)
+        max_length=250, null=True)
 
     description = models.TextField(null=True)
 
     message = models.TextField(null=True)
 
+    objects = ImportHistoryManager()
+
     def __str__(self):
         return '{}: {}'.format(self.source, self.import_datetime)
 
+    @property
+    def result_identifiers(self):
+        """Returns the list of order identifiers imported from the file in row order."""
+        return list(self.importedidentifier_set.order_by('row_number').values_list(
+            'order_identifier', flat=True))
+
     class Meta:
         app_label = 'getresults_csv'
         ordering = ('-import_datetime', )
+        index_together = (('import_datetime', 'success', 'source'), ('import_datetime', 'id'))
+
+
+class ImportRollup(BaseUuidModel):
+
+    """Daily totals of the import history per CSV format, updated on each import.
+
+    Imports that failed before their CSV format was known are counted with a
+    blank csv_format; it is not nullable so that it is unique per day."""
+
+    import_date = models.DateField()
+
+    csv_format = models.CharField(
+        max_length=25,
+        default='',
+        blank=True)
+
+    files = models.IntegerField(default=0)
+
+    records = models.IntegerField(default=0)
+
+    failures = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {}'.format(self.csv_format, self.import_date)
+
+    class Meta:
+        app_label = 'getresults_csv'
+        ordering = ('-import_date', 'csv_format')
+        unique_together = (('import_date', 'csv_format'), )
+
+
+class ImportedIdentifierManager(models.Manager):
+
+    def for_identifier(self, order_identifier):
+        return self.filter(order_identifier=order_identifier).select_related('import_history')
+
+    def bulk_record(self, import_history, identifiers, batch_size=None):
+        """Creates one instance per identifier of an OrderedDict of {order_identifier: row_number}."""
+        return self.bulk_create(
+            [self.model(
+                id=uuid4(),
+                import_history=import_history,
+                order_identifier=order_identifier,
+                row_number=row_number) for order_identifier, row_number in identifiers.items()],
+            batch_size=batch_size or 500)
+
+
+class ImportedIdentifier(BaseUuidModel):
+
+    """An order identifier imported from the file of an ImportHistory."""
+
+    import_history = models.ForeignKey(ImportHistory)
+
+    order_identifier = models.CharField(
+        max_length=50,
+        db_index=True)
+
+    row_number = models.IntegerField(null=True)
+
+    objects = ImportedIdentifierManager()
+
+    def __str__(self):
+        return '{}: {}'.format(self.order_identifier, self.import_history)
+
+    class Meta:
+        app_label = 'getresults_csv'
+        ordering = ('import_history', 'row_number')
 
 
 class FileImport(BaseUuidModel):
 
     source_filename = models.CharField(
-        max_length=50)
+        max_length=250)
 
     archive_filename = models.CharField(
-        max_length=50)
+        max_length=250,
+        null=True)
 
     record_count = models.IntegerField(null=True)
 
@@ -212,12 +363,117 @@ class FileImport(BaseUuidModel):
 
     description = models.TextField(null=True)
 
+    content_hash = models.CharField(
+        max_length=64,
+        null=True,
+        db_index=True,
+        help_text='sha256 of the file content')
+
+    file_size = models.BigIntegerField(null=True)
+
+    file_mtime = models.FloatField(null=True)
+
     def __str__(self):
         return '{}: {}'.format(self.source_filename, self.import_datetime)
 
     class Meta:
         app_label = 'getresults_csv'
         ordering = ('-import_datetime', )
+        index_together = (('source_filename', 'file_size', 'file_mtime'), )
+
+
+class ImportCheckpoint(BaseUuidModel):
+
+    """The byte offset up to which the rows of a file were saved, see checkpoint.py."""
+
+    source_path = models.CharField(
+        max_length=250,
+        unique=True)
+
+    file_size = models.BigIntegerField()
+
+    file_mtime = models.FloatField()
+
+    offset = models.BigIntegerField(default=0)
+
+    line_num = models.IntegerField(default=1)
+
+    inode = models.BigIntegerField(null=True)
+
+    header_hash = models.CharField(
+        max_length=40,
+        null=True,
+        help_text='sha1 of the header line of a tailed file')
+
+    def __str__(self):
+        return '{}: {}'.format(self.source_path, self.offset)
+
+    class Meta:
+        app_label = 'getresults_csv'
+
+
+class RowFingerprint(BaseUuidModel):
+
+    """A hash of the values of a row last saved from a file, see row_diff.py."""
+
+    source_key = models.CharField(
+        max_length=40,
+        help_text='sha1 of the CSV format name and full path of the file')
+
+    source_path = models.CharField(
+        max_length=250)
+
+    order_identifier = models.CharField(
+        max_length=50)
+
+    values_hash = models.CharField(
+        max_length=40)
+
+    import_number = models.IntegerField(
+        default=1,
+        help_text='the last import of the file that read the row')
+
+    def __str__(self):
+        return '{}: {}'.format(self.source_path, self.order_identifier)
+
+    class Meta:
+        app_label = 'getresults_csv'
+        unique_together = (('source_key', 'order_identifier'), )
+        index_together = (('source_key', 'import_number'), )
+
+
+class ArchiveEntry(BaseUuidModel):
+
+    """A file in the archive, see Archiver."""
+
+    source_filename = models.CharField(
+        max_length=250,
+        db_index=True)
+
+    content_hash = models.CharField(
+        max_length=64,
+        null=True,
+        db_index=True,
+        help_text='sha256 of the file content')
+
+    archive_path = models.CharField(
+        max_length=250,
+        unique=True)
+
+    archive_datetime = models.DateTimeField(
+        default=timezone.now)
+
+    bundle = models.CharField(
+        max_length=250,
+        null=True,
+        help_text='the tar bundle holding the archived file after compaction, see compact_archive')
+
+    def __str__(self):
+        return '{}: {}'.format(self.source_filename, self.archive_path)
+
+    class Meta:
+        app_label = 'getresults_csv'
+        ordering = ('-archive_datetime', )
 
 
 @receiver(post_save, weak=False, dispatch_uid='post_create_csv_format_fields')
@@ -225,15 +481,30 @@ def post_create_csv_format_fields(sender, instance, raw, created, using, update_
     if not raw:
         try:
             header_list = instance.get_header_as_list()
-            for fld in header_list:
-                try:
-                    CsvField.objects.get(
-                        csv_format=instance,
-                        name=fld
-                    )
-                except CsvField.DoesNotExist:
-                    CsvField.objects.create(
-                        csv_format=instance,
-                        name=fld)
         except AttributeError:
-            pass
+            return
+        if header_list:
+            existing = set(CsvField.objects.filter(csv_format=instance).values_list('name', flat=True))
+            CsvField.objects.bulk_create(
+                [CsvField(id=uuid4(), csv_format=instance, name=fld)
+                 for fld in OrderedDict.fromkeys(header_list) if fld not in existing],
+                batch_size=500)
+
+
+def get_import_date(import_datetime):
+    if timezone.is_aware(import_datetime):
+        import_datetime = timezone.localtime(import_datetime)
+    return import_datetime.date()
+
+
+@receiver(post_save, weak=False, dispatch_uid='import_rollup_on_post_save')
+def import_rollup_on_post_save(sender, instance, raw, created, using, update_fields, **kwargs):
+    """Adds a new ImportHistory to the ImportRollup of its day and CSV format."""
+    if not raw and created and sender == ImportHistory:
+        import_rollup, _ = ImportRollup.objects.get_or_create(
+            import_date=get_import_date(instance.import_datetime),
+            csv_format=instance.csv_format or '')
+        ImportRollup.objects.filter(pk=import_rollup.pk).update(
+            files=F('files') + 1,
+            records=F('records') + (instance.record_count or 0),
+            failures=F('failures') + (0 if instance.success else 1))
@@ -0,0 +1,217 @@
+import queue
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .checkpoint import get_checkpoint
+from .csv_result import CsvResult
+from .exceptions import CsvLoadError
+from .format_plan import get_format_plan
+
+try:
+    PARSE_WORKERS = settings.GETRESULTS_CSV_PARSE_WORKERS
+except AttributeError:
+    PARSE_WORKERS = None  # number of CPUs
+
+try:
+    SAVE_WORKERS = settings.GETRESULTS_CSV_SAVE_WORKERS
+except AttributeError:
+    SAVE_WORKERS = 2
+
+try:
+    QUEUE_SIZE = settings.GETRESULTS_CSV_QUEUE_SIZE
+except AttributeError:
+    QUEUE_SIZE = 16
+
+try:
+    CHUNK_SIZE = settings.GETRESULTS_CSV_PARSE_CHUNK_SIZE
+except AttributeError:
+    CHUNK_SIZE = 5000  # rows parsed per call of parse_file
+
+# rows and their line numbers, and where to continue reading the file
+ParsedChunk = namedtuple('ParsedChunk', 'rows line_nums offset line_num done')
+
+
+def parse_file(csv_format, format_plan, filename, identifier_exclude_patterns=None,
+               start_offset=None, start_line=None, max_rows=None):
+    """Returns a ParsedChunk of at most max_rows decoded rows of a file that
+    pass the row filter, read after start_offset (or start_line).
+
+    The file is read through a memory map, if its encoding allows, so that the
+    next chunk starts at the byte offset where this one stopped.
+
+    Runs in a worker process so it must not touch the database; the format plan
+    is passed in."""
+    csv_result = CsvResult(
+        csv_format, filename, format_plan=format_plan,
+        identifier_exclude_patterns=identifier_exclude_patterns,
+        use_mmap=True, start_offset=start_offset, start_line=start_line)
+    rows = []
+    line_nums = []
+    values_iter = csv_result.iter_rows()
+    try:
+        for values in values_iter:
+            rows.append(values)
+            line_nums.append(csv_result.line_num)
+            if len(rows) == max_rows:
+                return ParsedChunk(rows, line_nums, csv_result.offset, csv_result.line_num, False)
+    finally:
+        values_iter.close()
+    return ParsedChunk(rows, line_nums, csv_result.offset, csv_result.line_num, True)
+
+
+class ParsedRows(object):
+    """Yields (line_num, values) for the rows of a file parsed in chunks of at
+    most chunk_size rows by a process pool, see parse_file.
+
+    The next chunk is parsed while the rows of the current one are saved, so no
+    more than two chunks of a file are held in memory. Pass to CsvResult as `rows`."""
+
+    def __init__(self, executor, csv_format, format_plan, filename,
+                 identifier_exclude_patterns=None, chunk_size=None, start_line=None):
+        self.executor = executor
+        self.args = (csv_format, format_plan, filename, identifier_exclude_patterns)
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.future = self.submit(None, start_line)
+
+    def submit(self, start_offset, start_line):
+        return self.executor.submit(parse_file, *self.args, start_offset=start_offset,
+                                    start_line=start_line, max_rows=self.chunk_size)
+
+    def __iter__(self):
+        future, self.future = self.future, None
+        while future:
+            chunk = future.result()
+            future = None if chunk.done else self.submit(chunk.offset, chunk.line_num)
+            for line_num, values in zip(chunk.line_nums, chunk.rows):
+                yield line_num, values
+
+
+class ImportPipeline(object):
+    """Imports files in two stages connected by a bounded queue.
+
+    Files are parsed in a process pool (CSV decoding is CPU bound), in
+    chunks, see ParsedRows, and the parsed rows are saved, archived and
+    recorded in the import history by a pool of save threads, see
+    CsvFileHandler.read_csv_files. At most queue_size files are in the pipeline
+    at a time; beyond that :meth:`submit` blocks.
+
+    Each save thread saves with its own save handler for each event handler,
+    see CsvFileHandler.new_save_handler, so that the errors and caches of
+    a save handler are not shared between threads.
+
+    A file that fails before it is saved is recorded as failed through the
+    event handler's import_failed and its slot is released. If a parse
+    process dies the pool is broken; it is replaced by a new one.
+
+    If parse_workers is 0 files are parsed by the save threads.
+    """
+
+    def __init__(self, parse_workers=None, save_workers=None, queue_size=None):
+        self.parse_workers = PARSE_WORKERS if parse_workers is None else parse_workers
+        self.save_workers = save_workers or SAVE_WORKERS
+        self.queue_size = queue_size or QUEUE_SIZE
+        self.save_queue = queue.Queue(maxsize=self.queue_size)
+        self.slots = threading.BoundedSemaphore(self.queue_size)
+        self.executor_lock = threading.Lock()
+        if self.parse_workers == 0:
+            self.parse_executor = None
+        else:
+            self.parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+        self.threads = []
+        for _ in range(self.save_workers):
+            thread = threading.Thread(target=self.save_worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __str__(self):
+        return 'ImportPipeline(parse_workers={}, save_workers={}, queue_size={})'.format(
+            self.parse_workers, self.save_workers, self.queue_size)
+
+    def submit(self, event_handler, path, **kwargs):
+        """Queues a file for import by the event handler.
+
+        kwargs are passed on to the event handler's read_csv_files."""
+        self.slots.acquire()
+        executor = self.parse_executor
+        try:
+            parsed_rows = None
+            if executor:
+                try:
+                    parsed_rows = self.parse(event_handler, path, executor)
+                except (CsvLoadError, FileNotFoundError):
+                    pass  # read_csv_files records the error
+            self.save_queue.put((event_handler, path, parsed_rows, kwargs))
+        except Exception as e:
+            self.slots.release()
+            self.import_failed(event_handler, path, e, executor)
+
+    def parse(self, event_handler, path, executor):
+        """Returns the ParsedRows of the file, resuming after its checkpoint, if any."""
+        csv_format = event_handler.get_csv_format(path)
+        save_handler = event_handler.save_handler
+        checkpoint = get_checkpoint(path) if event_handler.use_checkpoints else None
+        return ParsedRows(
+            executor, csv_format, get_format_plan(csv_format), path,
+            list(save_handler.identifier_exclude_patterns) if save_handler else None,
+            start_line=checkpoint.line_num if checkpoint else None)
+
+    def save_worker(self):
+        save_handlers = {}  # of this thread, by event handler
+        while True:
+            item = self.save_queue.get()
+            if item is None:
+                self.save_queue.task_done()
+                break
+            event_handler, path, parsed_rows, kwargs = item
+            try:
+                try:
+                    save_handler = save_handlers[id(event_handler)]
+                except KeyError:
+                    save_handler = save_handlers[id(event_handler)] = event_handler.new_save_handler()
+                event_handler.read_csv_files(
+                    path, parsed_rows=parsed_rows, save_handler=save_handler, **kwargs)
+            except Exception as e:
+                self.import_failed(event_handler, path, e, parsed_rows.executor if parsed_rows else None)
+            finally:
+                close_old_connections()
+                self.slots.release()
+                self.save_queue.task_done()
+
+    def import_failed(self, event_handler, path, error, executor=None):
+        """Records the failed file through the event handler and replaces the
+        parse pool if it broke while parsing the file."""
+        if isinstance(error, BrokenProcessPool) and executor:
+            self.replace_parse_executor(executor)
+        try:
+            event_handler.import_failed(path, error)
+        except Exception as e:
+            event_handler.output_to_console('{} failed to import \'{}\'. Got {}'.format(
+                timezone.now(), path, str(e)))
+
+    def replace_parse_executor(self, executor):
+        """Shuts down a broken parse pool and starts a new one."""
+        with self.executor_lock:
+            if self.parse_executor is not executor:
+                return  # already replaced
+            executor.shutdown(wait=False)
+            self.parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+
+    def join(self):
+        """Waits until all queued files are imported."""
+        self.save_queue.join()
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.save_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.parse_executor:
+            self.parse_executor.shutdown()
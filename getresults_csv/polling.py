@@ -0,0 +1,132 @@
+import logging
+import os
+import re
+import threading
+
+from fnmatch import translate
+
+from django.conf import settings
+from django.utils import timezone
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent
+
+try:
+    POLLING_INTERVAL = settings.GETRESULTS_CSV_POLLING_INTERVAL
+except AttributeError:
+    POLLING_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def compile_patterns(patterns):
+    """Returns one compiled regex matching a filename against any of the fnmatch
+    patterns, or None if there are none."""
+    patterns = list(patterns or [])
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(translate(pattern)) for pattern in patterns))
+
+
+class FolderWatch(object):
+    """Detects new, changed and removed files in one folder by polling.
+
+    Each :meth:`scan` is a single os.scandir pass. Names are matched against
+    the event handler's patterns with one combined regex before anything is
+    stat'ed, so subfolders (e.g. the archive) and non-matching files cost
+    almost nothing. The (size, mtime, inode) of each matching file is kept and
+    compared with the previous scan to dispatch created, modified and deleted
+    events to the event handler. Errors are reported through the event
+    handler's output_to_console, if it has one, otherwise logged."""
+
+    def __init__(self, event_handler, path):
+        self.event_handler = event_handler
+        self.output = getattr(event_handler, 'output_to_console', logger.warning)
+        self.path = path
+        self.pattern = compile_patterns(event_handler.patterns)
+        self.cache = {}
+
+    def scan(self, emit=None):
+        """Scans the folder and dispatches the events found; with emit=False only
+        the cache is filled."""
+        emit = True if emit is None else emit
+        seen = self.read_folder()
+        if seen is None:
+            return []
+        events = []
+        for name, signature in seen.items():
+            previous = self.cache.get(name)
+            if previous is None:
+                events.append(FileCreatedEvent(os.path.join(self.path, name)))
+            elif previous != signature:
+                events.append(FileModifiedEvent(os.path.join(self.path, name)))
+        for name in self.cache:
+            if name not in seen:
+                events.append(FileDeletedEvent(os.path.join(self.path, name)))
+        self.cache = seen
+        if not emit:
+            return []
+        for event in events:
+            self.event_handler.dispatch(event)
+        return events
+
+    def read_folder(self):
+        """Returns {name: (size, mtime, inode)} of the matching files or None if
+        the folder cannot be read."""
+        seen = {}
+        try:
+            entries = os.scandir(self.path)
+        except OSError as e:  # e.g. the network share is not mounted
+            self.output('{} unable to scan \'{}\'. Got {}'.format(timezone.now(), self.path, str(e)))
+            return None
+        for entry in entries:
+            if self.pattern and not self.pattern.match(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    seen[entry.name] = (stat.st_size, stat.st_mtime, stat.st_ino)
+            except OSError:
+                continue
+        return seen
+
+
+class ScandirPollingObserver(object):
+    """An observer for folders where file system events never arrive, e.g.
+    SMB or NFS mounts, with the schedule/start/stop/join interface of
+    watchdog's Observer.
+
+    Every interval seconds each scheduled folder is scanned once, see
+    FolderWatch. Files already in a folder when it is scheduled are not reported;
+    see CsvFileHandler.process_existing_files."""
+
+    def __init__(self, interval=None):
+        self.interval = interval or POLLING_INTERVAL
+        self.watches = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def schedule(self, event_handler, path, recursive=False):
+        watch = FolderWatch(event_handler, path)
+        watch.scan(emit=False)
+        self.watches.append(watch)
+        return watch
+
+    def poll(self):
+        for watch in self.watches:
+            watch.scan()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        if self.thread:
+            self.thread.join()
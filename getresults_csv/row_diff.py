@@ -0,0 +1,101 @@
+import hashlib
+
+from uuid import uuid4
+
+from django.conf import settings
+from django.db.models import Max
+
+from .models import RowFingerprint
+
+try:
+    ROW_DIFF_KEEP_IMPORTS = settings.GETRESULTS_CSV_ROW_DIFF_KEEP_IMPORTS
+except AttributeError:
+    ROW_DIFF_KEEP_IMPORTS = 3  # imports of a file after which fingerprints of rows no longer in it are deleted
+
+
+def values_hash(values):
+    """Returns the sha1 of the converted values of a row."""
+    return hashlib.sha1('\x1f'.join(str(value) for value in values).encode('utf-8')).hexdigest()
+
+
+def source_key(csv_format_name, source_path):
+    """Returns the sha1 of the CSV format name and full path of a file."""
+    return hashlib.sha1('{}\x1f{}'.format(csv_format_name, source_path).encode('utf-8')).hexdigest()
+
+
+class RowDiff(object):
+    """Selects the rows of a file that were added or changed since the file
+    was last imported.
+
+    The fingerprint of a row is its order identifier and a hash of its
+    values, kept per file by CSV format and full path (see source_key).
+    :meth:`changed` looks up the fingerprints of the identifiers of one batch
+    and returns the items of the batch whose fingerprint is new; :meth:`commit`
+    records them once the batch is saved.
+
+    Each import of a file has the next import_number and marks the rows it
+    read with it. :meth:`prune` deletes the fingerprints of rows not in any
+    of the last keep_imports imports of the file."""
+
+    def __init__(self, csv_format_name, source_path, keep_imports=None):
+        self.source_key = source_key(csv_format_name, source_path)
+        self.source_path = source_path
+        self.keep_imports = keep_imports or ROW_DIFF_KEEP_IMPORTS
+        last_import = RowFingerprint.objects.filter(source_key=self.source_key).aggregate(
+            Max('import_number'))['import_number__max']
+        self.import_number = (last_import or 0) + 1
+        self.pending = {}
+        self.seen = []
+        self.unchanged = 0
+
+    def changed(self, items):
+        """Returns the list of items of a batch that were added or changed."""
+        items = list(items)
+        fingerprints = dict(RowFingerprint.objects.filter(
+            source_key=self.source_key,
+            order_identifier__in=set(str(item.order_identifier) for item in items)).values_list(
+                'order_identifier', 'values_hash'))
+        changed = []
+        for csv_result_item in items:
+            order_identifier = str(csv_result_item.order_identifier)
+            fingerprint = values_hash(csv_result_item.values)
+            if fingerprints.get(order_identifier) == fingerprint:
+                self.unchanged += 1
+                self.seen.append(order_identifier)
+                continue
+            self.pending[order_identifier] = (fingerprint, order_identifier in fingerprints)
+            changed.append(csv_result_item)
+        return changed
+
+    def commit(self):
+        """Records the fingerprints of the rows saved since the last commit and
+        marks the unchanged rows as read by this import."""
+        new = []
+        for order_identifier, (fingerprint, exists) in self.pending.items():
+            if exists:
+                RowFingerprint.objects.filter(
+                    source_key=self.source_key,
+                    order_identifier=order_identifier).update(
+                        values_hash=fingerprint, import_number=self.import_number)
+            else:
+                new.append(RowFingerprint(
+                    id=uuid4(),
+                    source_key=self.source_key,
+                    source_path=self.source_path[-250:],
+                    order_identifier=order_identifier,
+                    values_hash=fingerprint,
+                    import_number=self.import_number))
+        RowFingerprint.objects.bulk_create(new, batch_size=500)
+        if self.seen:
+            RowFingerprint.objects.filter(
+                source_key=self.source_key,
+                order_identifier__in=self.seen).update(import_number=self.import_number)
+        self.pending = {}
+        self.seen = []
+
+    def prune(self):
+        """Deletes the fingerprints of the rows not read by the last keep_imports
+        imports of the file."""
+        RowFingerprint.objects.filter(
+            source_key=self.source_key,
+            import_number__lte=self.import_number - self.keep_imports).delete()
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+try:
+    QUIET_PERIOD = settings.GETRESULTS_CSV_QUIET_PERIOD
+except AttributeError:
+    QUIET_PERIOD = 2.0
+
+try:
+    POLL_INTERVAL = settings.GETRESULTS_CSV_POLL_INTERVAL
+except AttributeError:
+    POLL_INTERVAL = 0.5
+
+try:
+    MAX_ATTEMPTS = settings.GETRESULTS_CSV_MAX_ATTEMPTS
+except AttributeError:
+    MAX_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class EventCoalescer(object):
+    """Merges the file events of each path and calls `callback(path)` once the
+    file is complete.
+
+    An analyzer export fires several created/modified events while it is
+    written. Events are merged per path until no event arrived for quiet_period
+    seconds and then the file must have the same size and mtime on two
+    consecutive checks. A path reported as complete (e.g. the destination of
+    a .tmp rename) skips both checks. Each complete file is passed to the callback
+    exactly once; a later event for the same path starts over.
+
+    If the callback raises, the path starts over as if it had a new event and
+    is retried. After max_attempts `on_failure(path, error)`, if given, is
+    called instead.
+
+    Errors are reported through `output(message)`, e.g. the output_to_console
+    of the event handler, or logged if it is not given.
+    """
+
+    def __init__(self, callback, quiet_period=None, poll_interval=None, max_attempts=None,
+                 on_failure=None, output=None):
+        self.callback = callback
+        self.output = output or logger.warning
+        self.quiet_period = QUIET_PERIOD if quiet_period is None else quiet_period
+        self.poll_interval = poll_interval or POLL_INTERVAL
+        self.max_attempts = max_attempts or MAX_ATTEMPTS
+        self.on_failure = on_failure
+        self.pending = {}
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, path, complete=None):
+        """Records an event for path."""
+        with self.lock:
+            try:
+                entry = self.pending[path]
+            except KeyError:
+                entry = self.pending[path] = {'signature': None, 'complete': False}
+            entry['last_event'] = time.time()
+            entry['complete'] = entry['complete'] or bool(complete)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def ready(self, now=None):
+        """Removes and returns the paths that are complete."""
+        now = time.time() if now is None else now
+        ready = []
+        with self.lock:
+            for path, entry in list(self.pending.items()):
+                if entry['complete']:
+                    ready.append(path)
+                    del self.pending[path]
+                    continue
+                if now - entry['last_event'] < self.quiet_period:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.pending[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime)
+                if signature == entry['signature']:
+                    ready.append(path)
+                    del self.pending[path]
+                else:
+                    entry['signature'] = signature
+        return ready
+
+    def flush(self, now=None):
+        """Calls the callback for each complete path.
+
+        An error is caught per path so that it does not stop the thread, see
+        :meth:`failed`."""
+        for path in self.ready(now):
+            try:
+                self.callback(path)
+            except Exception as e:
+                self.failed(path, e)
+            else:
+                self.attempts.pop(path, None)
+            finally:
+                close_old_connections()
+
+    def failed(self, path, error):
+        """Queues path again or, after max_attempts, passes it to on_failure."""
+        attempts = self.attempts.get(path, 0) + 1
+        self.output('{} unable to import \'{}\' (attempt {} of {}). Got {}'.format(
+            timezone.now(), path, attempts, self.max_attempts, str(error)))
+        if attempts < self.max_attempts:
+            self.attempts[path] = attempts
+            self.add(path)
+            return
+        self.attempts.pop(path, None)
+        if self.on_failure:
+            try:
+                self.on_failure(path, error)
+            except Exception as e:
+                self.output('{} unable to record the failed import of \'{}\'. Got {}'.format(
+                    timezone.now(), path, str(e)))
+
+    def run(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.flush()
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -5,6 +5,8 @@ from django.utils import timezone
 from paramiko import SSHClient
 from watchdog.observers import Observer
 
+from .polling import ScandirPollingObserver
+
 
 class ServerError(Exception):
     pass
@@ -24,23 +26,58 @@ class Server(object):
         """
         See management command :func:`start_observer` or tests for usage.
 
-        :param event_handler: an instance of :class:`BaseEventHandler`.
+        :param event_handler: an instance of :class:`BaseEventHandler` or a list
+                              of instances, one per watched source folder.
         """
-        self.event_handler = event_handler
+        if isinstance(event_handler, (list, tuple)):
+            self.event_handlers = list(event_handler)
+        else:
+            self.event_handlers = [event_handler]
+        self.event_handler = self.event_handlers[0]
 
     def __str__(self):
         return 'Server started on {}'.format(timezone.now())
 
-    def observe(self, sleep=None):
-        with SSHClient() as self.event_handler.ssh:
-            observer = Observer()
-            observer.schedule(self.event_handler, path=self.event_handler.source_dir)
-            self.event_handler.connect()
-            self.event_handler.process_existing_files()
-            observer.start()
+    def observe(self, sleep=None, polling=None, poll_interval=None):
+        """Schedules all event handlers on a single observer.
+
+        Event handlers with `polling` set, or all of them if polling is True,
+        are scheduled on a ScandirPollingObserver instead, for folders (e.g.
+        network shares) where file system events do not arrive."""
+        with SSHClient() as ssh:
+            observers = {}
+            for event_handler in self.event_handlers:
+                event_handler.ssh = ssh
+                observer = self.get_observer(observers, event_handler, polling, poll_interval)
+                observer.schedule(event_handler, path=event_handler.source_dir)
+                event_handler.connect()
+                event_handler.process_existing_files()
+            for observer in observers.values():
+                observer.start()
             try:
                 while True:
                     time.sleep(sleep or 1)
             except KeyboardInterrupt:
-                observer.stop()
-            observer.join()
+                for observer in observers.values():
+                    observer.stop()
+            for observer in observers.values():
+                observer.join()
+            self.shutdown()
+
+    def shutdown(self):
+        """Disconnects the event handlers and shuts down their pipelines."""
+        for event_handler in self.event_handlers:
+            event_handler.disconnect()
+        for pipeline in set(event_handler.pipeline for event_handler in self.event_handlers):
+            if pipeline:
+                pipeline.shutdown()
+
+    def get_observer(self, observers, event_handler, polling=None, poll_interval=None):
+        """Returns the observer for event_handler from observers, creating it if needed."""
+        use_polling = bool(polling or getattr(event_handler, 'polling', False))
+        try:
+            observer = observers[use_polling]
+        except KeyError:
+            observer = ScandirPollingObserver(poll_interval) if use_polling else Observer()
+            observers[use_polling] = observer
+        return observer
@@ -1,27 +1,91 @@
+import csv
+import gzip
+import io
 import os
+import pickle
+import shutil
+import tarfile
+import tempfile
+import time
 
 from os.path import join
 from unipath.path import Path
-from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import skipIf
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
+from getresults_csv.archiver import Archiver, compact_archive
+from getresults_csv.checkpoint import get_checkpoint, save_checkpoint
+from getresults_csv.bindings import make_event_handlers, read_bindings
 from getresults_csv.configure import Configure
 from getresults_csv.csv_file_handler import CsvFileHandler
 from getresults_csv.csv_result import CsvResult, BaseSaveHandler
+from getresults_csv.exceptions import CsvLoadError
+from getresults_csv.format_plan import clear_format_plans, get_format_index, get_format_plan, FormatIndex
+from getresults_csv.localize import localize
+from getresults_csv.pipeline import ImportPipeline, ParsedRows, parse_file
+from getresults_csv.polling import FolderWatch, ScandirPollingObserver
+from getresults_csv.row_diff import RowDiff
+from getresults_csv.scheduler import EventCoalescer
+from getresults_csv.tokenizer import simple_split_reader
+from getresults_csv.views import keyset_page
+from getresults_csv.vectorised import np
+from getresults_csv.getresults.dmis_lookup import DmisReceiveLookup
+from getresults_csv.getresults.reference_cache import reference_cache
+from getresults_csv.getresults.resolvers import OrderResolver
 from getresults_csv.getresults.save_handlers import Multiset2DMISSaveHandler
-from getresults_csv.models import CsvFormat, CsvField, CsvDictionary, ImportHistory
-from getresults_order.models import Utestid
+from getresults_csv.models import (
+    ArchiveEntry, CsvFormat, CsvField, CsvDictionary, FileImport, ImportHistory, ImportedIdentifier, ImportRollup,
+    RowFingerprint)
+from getresults_receive.models import Receive
+from getresults_order.models import Order, OrderPanelItem, Utestid
 from getresults_order.configure import Configure as ConfigureOrder
 from getresults_sender.configure import Configure as ConfigureSender
+from getresults_sender.models import SenderPanel
 
 from getresults_result.models import Result, ResultItem
 
 
+class FakeDmisSaveHandler(Multiset2DMISSaveHandler):
+
+    def get_dmis_receive(self, order_identifier):
+        """A method to fake calling the SQL Server DB."""
+        attrs = {
+            'receive_identifier': order_identifier,
+            'edc_specimen_identifier': None,
+            'protocol_number': 'BHP099',
+            'patient_identifier': '1234567',
+            'receive_datetime': timezone.now(),
+            'drawn_datetime': timezone.now() - timedelta(days=1)}
+        Receive = type('Receive', (object, ), attrs)
+        return Receive()
+
+
+class RecordingSaveHandler(BaseSaveHandler):
+
+    """Records the order identifiers of each batch instead of saving it."""
+
+    def __init__(self):
+        super(RecordingSaveHandler, self).__init__()
+        self.batches = []
+
+    def save_batch(self, csv_format, items):
+        self.batches.append([str(item.order_identifier) for item in items])
+
+    @property
+    def saved(self):
+        return [order_identifier for batch in self.batches for order_identifier in batch]
+
+
 class TestGetresults(TestCase):
 
     def setUp(self):
+        reference_cache.clear()
         self.source_dir = join(Path(os.path.dirname(os.path.realpath(__file__))).ancestor(1), 'testdata')
         configure_order = ConfigureOrder(
             utestid_file=os.path.join(self.source_dir, 'utestids.csv'),
@@ -195,5 +259,711 @@ class TestGetresults(TestCase):
             self.assertEqual(
                 import_history.description,
                 'CSV Format \'Multiset\' using save handler \'Multiset CSV to DMIS\'')
+            self.assertEqual(len(import_history.result_identifiers), 10)
+            self.assertEqual(import_history.result_identifiers[0], 'AA11562')
+        self.assertEqual(
+            [import_history.source for import_history in ImportHistory.objects.for_identifier('AA11562')],
+            ['rad9A6A3.csv'])
+        imported_identifier = ImportedIdentifier.objects.for_identifier('AA11562')[0]
+        self.assertEqual(imported_identifier.row_number, 2)
+
+    def test_format_plan_resolves_columns_once(self):
+        clear_format_plans()
+        with self.assertNumQueries(1):
+            csv_result = CsvResult(self.csv_format, self.sample_filename())
+            csv_result.load()
+        self.assertEqual(len(csv_result), 10)
+        self.assertEqual(len(csv_result.format_plan.columns), 11)
+        with self.assertNumQueries(0):
+            CsvResult(self.csv_format, self.sample_filename()).load()
+        Utestid.objects.get(name='CD4').save()
+        self.assertIsNot(get_format_plan(self.csv_format), csv_result.format_plan)
+        format_index = get_format_index()
+        self.assertIs(get_format_index(), format_index)
+        self.assertIsNot(get_format_index(reload=True), format_index)
+
+    def test_file_handler_saves_in_batches(self):
+        save_handler = RecordingSaveHandler()
+        event_handler = CsvFileHandler(
+            csv_format=self.csv_format,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv'],
+            save_handler=save_handler,
+            verbose=False,
+            batch_size=4)
+        csv_result = event_handler.read_csv_files(self.sample_filename())
+        self.assertEqual([len(batch) for batch in save_handler.batches], [4, 4, 2])
+        self.assertEqual(len(csv_result), 10)
+        self.assertEqual(csv_result.results, {})
+
+    def test_csv_result_item_values_are_typed(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        csv_result_item = csv_result.results['AA11562']
+        self.assertEqual(csv_result_item.order_identifier, 'AA11562')
+        self.assertEqual(csv_result_item.sender_panel, 'CD3/CD8/CD45/CD4 TRUC')
+        self.assertIsInstance(csv_result_item.collection_date, datetime)
+        self.assertIsInstance(csv_result_item.result_datetime, datetime)
+        self.assertEqual(getattr(csv_result_item, 'CD4'), Decimal('231.07'))
+
+    def test_csv_format_datetime_formats(self):
+        self.csv_format.datetime_formats = '%a, %b %d, %Y %I:%M %p|%a, %b %d, %Y'
+        self.csv_format.save()
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        csv_result_item = csv_result.results['AA11562']
+        self.assertEqual(
+            csv_result_item.collection_date,
+            localize(datetime(2015, 6, 3, 15, 21)))
+        self.assertEqual(
+            csv_result_item.result_datetime,
+            localize(datetime(2015, 6, 3)))
+
+    def test_csv_result_batch_is_columnar(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        batch = next(csv_result.iter_batches(10))
+        self.assertEqual(len(batch), 10)
+        self.assertEqual(len(batch.column('order_identifier')), 10)
+        csv_result_item = batch[0]
+        self.assertIs(csv_result_item.schema, batch.schema)
+        self.assertEqual(csv_result_item.order_identifier, batch.column('order_identifier')[0])
+        self.assertEqual(getattr(csv_result_item, 'CD4%'), batch.column('CD4%')[0])
+        self.assertEqual(csv_result_item.source, self.sample_filename())
+        self.assertFalse(hasattr(csv_result_item, '__dict__'))
+
+    @skipIf(np is None, 'numpy is not installed')
+    def test_vectorised_batches(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        batches = list(csv_result.iter_vectorised_batches(4))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertEqual(len(csv_result), 10)
+        batch = batches[0]
+        self.assertEqual(batch.column('CD4')[0], 231.07)
+        self.assertEqual(batch[0].order_identifier, 'AA11562')
+        self.assertEqual(batch[0].sender_panel, 'CD3/CD8/CD45/CD4 TRUC')
+
+    def test_csv_field_not_in_header_is_none(self):
+        csv_field = CsvField.objects.create(csv_format=self.csv_format, name='phm')
+        CsvDictionary.objects.create(
+            csv_format=self.csv_format, utestid=Utestid.objects.get(name='PHM'), csv_field=csv_field)
+        clear_format_plans()
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        self.assertEqual(len(csv_result), 10)
+        self.assertEqual([item.as_dict()['PHM'] for item in csv_result], [None] * 10)
+        if np is not None:
+            batches = list(CsvResult(self.csv_format, self.sample_filename()).iter_vectorised_batches(4))
+            self.assertEqual(batches[0].column('PHM'), [None] * 4)
+            self.assertEqual(batches[0].column('CD4')[0], 231.07)
+
+    def test_readers_count_blank_lines(self):
+        with open(self.sample_filename(), 'rb') as f:
+            lines = f.read().split(b'\r')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = join(tmp_dir, 'blank.csv')
+            with open(path, 'wb') as f:
+                f.write(b'\r'.join(lines[:3] + [b''] + lines[3:]))
+            csv_result = CsvResult(self.csv_format, path)
+            csv_result.load()
+            expected = list(csv_result.identifiers.items())
+            self.assertEqual(expected[2], ('AA11540', 5))
+            mmap_result = CsvResult(self.csv_format, path, use_mmap=True)
+            mmap_result.load()
+            self.assertEqual(list(mmap_result.identifiers.items()), expected)
+            self.csv_format.simple_split = True
+            self.csv_format.save()
+            simple_result = CsvResult(self.csv_format, path)
+            simple_result.load()
+            self.assertEqual(list(simple_result.identifiers.items()), expected)
+            if np is not None:
+                vectorised_result = CsvResult(self.csv_format, path)
+                list(vectorised_result.iter_vectorised_batches(4))
+                self.assertEqual(list(vectorised_result.identifiers.items()), expected)
+                with open(path, 'ab') as f:
+                    f.write(b'\xff\xfe\r')
+                self.assertRaises(CsvLoadError, list, CsvResult(self.csv_format, path).iter_vectorised_batches(4))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_simple_split_reads_same_as_csv_reader(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        self.csv_format.simple_split = True
+        self.csv_format.save()
+        csv_result_simple = CsvResult(self.csv_format, self.sample_filename())
+        csv_result_simple.load()
+        self.assertTrue(csv_result_simple.format_plan.simple_split)
+        self.assertEqual(
+            [item.as_list() for item in csv_result],
+            [item.as_list() for item in csv_result_simple])
+
+    def test_simple_split_takes_stray_quotes_literally(self):
+        data = 'a,b,c\r\n1,O"Brien,x\r\n2,"multi\r\nline",y\r\n3,"q""uote",z\r\n4,x"",v\r\n'
+        self.assertEqual(
+            list(simple_split_reader(io.StringIO(data, newline=''), ',')),
+            list(csv.reader(io.StringIO(data, newline=''))))
+
+    def test_format_index_routes_by_header(self):
+        format_index = FormatIndex()
+        self.assertEqual(format_index.route(self.sample_filename()), self.csv_format)
+        self.assertEqual(format_index.route(self.sample_filename('vl.csv')), self.csv_format_vl)
+        self.assertIsNone(format_index.route(self.sample_filename('senders.csv')))
+
+    def test_file_handler_routes_files_without_csv_format(self):
+        event_handler = CsvFileHandler(
+            csv_format=None,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv', 'vl.csv'],
+            save_handler=BaseSaveHandler(),
+            verbose=False)
+        csv_result = event_handler.read_csv_files(self.sample_filename('vl.csv'))
+        self.assertEqual(csv_result.csv_format, self.csv_format_vl)
+        self.assertEqual(len(csv_result), 5)
+        csv_result = event_handler.read_csv_files(self.sample_filename())
+        self.assertEqual(csv_result.csv_format, self.csv_format)
+
+    def test_bindings_make_event_handlers(self):
+        bindings = read_bindings(join(self.source_dir, 'bindings.csv'))
+        self.assertEqual(len(bindings), 2)
+        self.assertEqual(bindings[0]['source_dir'], join(self.source_dir, '.'))
+        self.assertEqual(bindings[1]['patterns'], ['vl.csv'])
+        event_handlers = make_event_handlers(bindings, BaseSaveHandler, verbose=False)
+        self.assertEqual(
+            [event_handler.csv_format for event_handler in event_handlers],
+            [self.csv_format, self.csv_format_vl])
+        self.assertIsNot(event_handlers[0].save_handler, event_handlers[1].save_handler)
+
+    def test_parse_file_in_worker_process(self):
+        format_plan = pickle.loads(pickle.dumps(get_format_plan(self.csv_format)))
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(parse_file, self.csv_format, format_plan, self.sample_filename(), max_rows=4)
+            chunk = future.result()
+            self.assertEqual((len(chunk.rows), chunk.line_nums[-1], chunk.done), (4, 5, False))
+            parsed_rows = ParsedRows(executor, self.csv_format, format_plan, self.sample_filename(), chunk_size=4)
+            csv_result = CsvResult(self.csv_format, self.sample_filename(), rows=parsed_rows)
+            csv_result.load()
+        expected = CsvResult(self.csv_format, self.sample_filename())
+        expected.load()
+        self.assertEqual(
+            [item.as_list() for item in csv_result],
+            [item.as_list() for item in expected])
+        self.assertEqual(list(csv_result.identifiers.values()), list(range(2, 12)))
+
+    def test_save_handler_per_thread_and_errors_per_file(self):
+
+        class FailingSaveHandler(BaseSaveHandler):
+
+            def save_batch(self, csv_format, items):
+                if 'fail' in items.schema.source:
+                    self.error_messages.append('failed')
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(join(tmp_dir, 'archive'))
+            for filename in ['fail.csv', 'ok.csv']:
+                shutil.copy(self.sample_filename(), join(tmp_dir, filename))
+            event_handler = CsvFileHandler(
+                csv_format=self.csv_format.name, source_dir=tmp_dir, archive_dir=join(tmp_dir, 'archive'),
+                save_handler=FailingSaveHandler(), save_handler_factory=FailingSaveHandler, verbose=False)
+            save_handler = event_handler.new_save_handler()
+            self.assertIsNot(save_handler, event_handler.save_handler)
+            for filename in ['fail.csv', 'ok.csv']:
+                event_handler.read_csv_files(join(tmp_dir, filename), save_handler=save_handler)
+            self.assertEqual(event_handler.save_handler.error_messages, [])
+            self.assertEqual(
+                list(ImportHistory.objects.order_by('source').values_list('source', 'success')),
+                [('fail.csv', False), ('ok.csv', True)])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_pipeline_releases_slot_and_records_failed_submit(self):
+
+        class UnreadableFileHandler(CsvFileHandler):
+
+            def get_csv_format(self, src_path):
+                raise PermissionError(src_path)
+
+        event_handler = UnreadableFileHandler(
+            csv_format=self.csv_format.name, source_dir=os.path.dirname(self.sample_filename()),
+            archive_dir=None, save_handler=RecordingSaveHandler(), verbose=False)
+        pipeline = ImportPipeline(parse_workers=1, save_workers=1, queue_size=1)
+        try:
+            pipeline.submit(event_handler, self.sample_filename())
+            self.assertTrue(pipeline.slots.acquire(timeout=1))
+            pipeline.slots.release()
+        finally:
+            pipeline.shutdown()
+        self.assertEqual(
+            list(ImportHistory.objects.values_list('source', 'success')),
+            [(os.path.basename(self.sample_filename()), False)])
+
+    def test_event_coalescer_imports_complete_file_once(self):
+        imported = []
+        coalescer = EventCoalescer(imported.append, quiet_period=1.0)
+        path = self.sample_filename()
+        now = time.time()
+        for _ in range(3):
+            coalescer.add(path)
+        coalescer.flush(now=now)
+        self.assertEqual(imported, [])
+        coalescer.flush(now=now + 2)  # quiet, records size and mtime
+        self.assertEqual(imported, [])
+        coalescer.flush(now=now + 3)  # unchanged, complete
+        self.assertEqual(imported, [path])
+        coalescer.flush(now=now + 4)
+        self.assertEqual(imported, [path])
+        coalescer.add(path, complete=True)
+        coalescer.flush(now=now + 5)
+        self.assertEqual(imported, [path, path])
+
+    def test_event_coalescer_retries_failed_imports(self):
+        calls = []
+        failures = []
+
+        def callback(path):
+            calls.append(path)
+            if len(calls) != 2:
+                raise FileNotFoundError(path)
+
+        messages = []
+        coalescer = EventCoalescer(
+            callback, quiet_period=1.0, max_attempts=2,
+            on_failure=lambda path, error: failures.append(path), output=messages.append)
+        path = self.sample_filename()
+        coalescer.add(path, complete=True)
+        coalescer.flush()
+        self.assertEqual((calls, len(coalescer)), ([path], 1))
+        now = time.time()
+        coalescer.flush(now=now + 2)
+        coalescer.flush(now=now + 3)
+        self.assertEqual((calls, len(coalescer), failures), ([path, path], 0, []))
+        coalescer.add(path, complete=True)
+        coalescer.flush()
+        self.assertEqual((len(calls), len(coalescer), failures), (3, 1, []))
+        coalescer.add(path, complete=True)
+        coalescer.flush()
+        self.assertEqual((len(calls), len(coalescer), failures), (4, 0, [path]))
+        self.assertEqual(len(messages), 3)
+
+    def test_ledger_skips_imported_files(self):
+        save_handler = RecordingSaveHandler()
+        event_handler = CsvFileHandler(
+            csv_format=self.csv_format,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv'],
+            save_handler=save_handler,
+            verbose=False)
+        event_handler.process_existing_files()
+        event_handler.process_existing_files()
+        self.assertEqual([len(batch) for batch in save_handler.batches], [10])
+        self.assertEqual(FileImport.objects.filter(imported=True).count(), 1)
+        # a new handler, e.g. after a restart, loads the ledger
+        event_handler = CsvFileHandler(
+            csv_format=self.csv_format,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv'],
+            save_handler=RecordingSaveHandler(),
+            verbose=False)
+        self.assertTrue(event_handler.ledger.entry(self.sample_filename()).imported)
+        event_handler.process_existing_files()
+        self.assertEqual(event_handler.save_handler.batches, [])
+
+    def test_ledger_records_long_filenames_in_full(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = '{}.csv'.format('rad9A6A3' * 10)
+            shutil.copy(self.sample_filename(), join(tmp_dir, filename))
+            event_handler = CsvFileHandler(
+                csv_format=self.csv_format,
+                source_dir=tmp_dir,
+                archive_dir=None,
+                save_handler=FakeDmisSaveHandler(),
+                verbose=False)
+            event_handler.process_existing_files()
+            self.assertEqual(Result.objects.all().count(), 10)
+            self.assertEqual(
+                list(FileImport.objects.filter(imported=True).values_list('source_filename', flat=True)),
+                [filename])
+            self.assertTrue(event_handler.ledger.entry(join(tmp_dir, filename)).imported)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_file_handler_with_dmis_bulk(self):
+        event_handler = CsvFileHandler(
+            csv_format=self.csv_format,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv'],
+            save_handler=FakeDmisSaveHandler(bulk=True),
+            verbose=False)
+        event_handler.process_existing_files()
+        self.assertEqual(Result.objects.all().count(), 10)
+        self.assertEqual(ResultItem.objects.all().count(), 40)
+        for result in Result.objects.all():
+            self.assertEqual(ResultItem.objects.filter(result=result).count(), 4)
+
+    def test_order_resolver_resolves_batch(self):
+        sender_panel = SenderPanel.objects.all()[0]
+        collection_date = timezone.now()
+        requests = {
+            identifier: (collection_date, sender_panel.order_panel)
+            for identifier in ['AA11562', 'AA11528', 'AA11540']}
+        orders = OrderResolver().resolve(requests)
+        self.assertEqual(sorted(orders), sorted(requests))
+        self.assertEqual(Order.objects.filter(order_identifier__in=list(requests)).count(), 3)
+        with self.assertNumQueries(1):
+            orders_again = OrderResolver().resolve(requests)
+        self.assertEqual(
+            {k: v.pk for k, v in orders.items()},
+            {k: v.pk for k, v in orders_again.items()})
+
+    def test_reference_cache_serves_lookups_from_memory(self):
+        sender_panel = SenderPanel.objects.all()[0]
+        order_panel_item_count = OrderPanelItem.objects.filter(order_panel=sender_panel.order_panel).count()
+        reference_cache.get_sender_panel(sender_panel.name)
+        with self.assertNumQueries(0):
+            self.assertEqual(reference_cache.get_sender_panel(sender_panel.name), sender_panel)
+            order_panel_items = reference_cache.get_order_panel_items(sender_panel.order_panel)
+            self.assertEqual(len(order_panel_items), order_panel_item_count)
+            for order_panel_item in order_panel_items:
+                self.assertTrue(order_panel_item.utestid.name)
+        sender_panel.save()
+        self.assertIsNone(reference_cache.loaded)
+        data = reference_cache.load()
+        del data.sender_panels[sender_panel.name]  # as if added by another process since
+        self.assertEqual(reference_cache.get_sender_panel(sender_panel.name), sender_panel)
+        self.assertIsNot(reference_cache.data, data)
+        self.assertRaises(SenderPanel.DoesNotExist, reference_cache.get_sender_panel, 'unknown panel')
+
+    def test_dmis_lookup_batches_and_caches(self):
+        """Assert receives are looked up in chunks and hits and misses are cached
+        (getresults_receive.Receive on 'default' stands in for the DMIS receive)."""
+        sender_panel = SenderPanel.objects.all()[0]
+        identifiers = ['AA11562', 'AA11528', 'AA11540']
+        OrderResolver().resolve({
+            identifier: (timezone.now(), sender_panel.order_panel) for identifier in identifiers})
+        lookup = DmisReceiveLookup(Receive, using='default', chunk_size=2)
+        with self.assertNumQueries(2):
+            receives = lookup.get_many(identifiers + ['AA00000'])
+        self.assertEqual(sorted(k for k, v in receives.items() if v), sorted(identifiers))
+        self.assertIsNone(receives['AA00000'])
+        self.assertEqual(lookup.last_metrics['found'], 3)
+        self.assertEqual(lookup.last_metrics['not_found'], 1)
+        with self.assertNumQueries(0):
+            self.assertIsNone(lookup.get('AA00000'))
+            self.assertEqual(lookup.get('AA11562').receive_identifier, 'AA11562')
+        self.assertEqual(lookup.metrics['cache_hits'], 2)
+
+    def test_csv_format_row_filters(self):
+        self.csv_format.identifier_exclude_patterns = '^AA1156\n^AA1152'
+        self.csv_format.save()
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        self.assertTrue(csv_result.results)
+        self.assertNotIn('AA11562', csv_result.results)
+        self.assertNotIn('AA11528', csv_result.results)
+        self.assertIn('AA11540', csv_result.results)
+        self.csv_format.identifier_exclude_patterns = None
+        self.csv_format.panel_allow_list = 'NOT A PANEL'
+        self.csv_format.save()
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        csv_result.load()
+        self.assertEqual(len(csv_result), 0)
+
+    def test_csv_format_invalid_exclude_pattern(self):
+        self.csv_format.identifier_exclude_patterns = '^AA1156\n^AA(1152'
+        self.assertRaises(ValidationError, self.csv_format.clean)
+        self.csv_format.save()
+        self.assertRaises(CsvLoadError, CsvResult, self.csv_format, self.sample_filename())
+        event_handler = CsvFileHandler(
+            csv_format=self.csv_format,
+            source_dir=self.source_dir,
+            archive_dir=None,
+            patterns=['rad9A6A3.csv'],
+            save_handler=RecordingSaveHandler(),
+            verbose=False)
+        event_handler.process_existing_files()
+        self.assertEqual(event_handler.save_handler.batches, [])
+        self.assertEqual(list(ImportHistory.objects.values_list('success', flat=True)), [False])
+
+    def test_save_handler_exclude_patterns_do_not_grow(self):
+        Multiset2DMISSaveHandler()
+        Multiset2DMISSaveHandler()
+        self.assertEqual(Multiset2DMISSaveHandler.identifier_exclude_patterns, [r'^[0-9]{6}$', r'^[0-9]{5}$'])
+        self.assertTrue(Multiset2DMISSaveHandler().exclude_by_pattern('123456'))
+
+    def test_import_rollup_is_updated_on_import(self):
+        now = timezone.now()
+        ImportHistory.objects.create(source='a.csv', csv_format='Multiset', success=True, record_count=10)
+        ImportHistory.objects.create(source='b.csv', csv_format='Multiset', success=False)
+        ImportHistory.objects.create(source='c.csv', csv_format='VL', success=True, record_count=3)
+        import_rollup = ImportRollup.objects.get(csv_format='Multiset')
+        self.assertEqual(import_rollup.import_date, timezone.localtime(now).date())
+        self.assertEqual((import_rollup.files, import_rollup.records, import_rollup.failures), (2, 10, 1))
+        self.assertEqual(ImportRollup.objects.get(csv_format='VL').records, 3)
+        for source in ['d.csv', 'e.csv']:
+            ImportHistory.objects.create(source=source, csv_format=None, success=False)
+        self.assertEqual(ImportRollup.objects.get(csv_format='').failures, 2)
+
+    def test_import_history_keyset_page(self):
+        now = timezone.now()
+        for index in range(5):
+            ImportHistory.objects.create(
+                source='{}.csv'.format(index), import_datetime=now - timedelta(minutes=index))
+        objects, cursor = keyset_page(ImportHistory.objects.all(), page_size=2)
+        self.assertEqual([obj.source for obj in objects], ['0.csv', '1.csv'])
+        objects, cursor = keyset_page(ImportHistory.objects.all(), cursor=cursor, page_size=2)
+        self.assertEqual([obj.source for obj in objects], ['2.csv', '3.csv'])
+        objects, cursor = keyset_page(ImportHistory.objects.all(), cursor=cursor, page_size=2)
+        self.assertEqual([obj.source for obj in objects], ['4.csv'])
+        self.assertIsNone(cursor)
+
+    def test_configure_bulk_load(self):
+        configure = Configure(
+            csv_formats_filename=join(self.source_dir, 'csv_formats.csv'),
+            csv_dictionaries_filename=join(self.source_dir, 'csv_dictionaries.csv'),
+            import_path=self.source_dir, load=False, bulk=True)
+        configure.load_all()
+        csv_format = CsvFormat.objects.get(name='amplicore')
+        self.assertEqual(CsvField.objects.filter(csv_format=csv_format).count(), 8)
+        self.assertEqual(CsvDictionary.objects.filter(csv_format=csv_format).count(), 8)
+        self.assertTrue(CsvDictionary.objects.filter(csv_format=csv_format, utestid__name='PHM').exists())
+        csv_dictionary_count = CsvDictionary.objects.count()
+        configure.load_all()
+        self.assertEqual(CsvDictionary.objects.count(), csv_dictionary_count)
+
+    def test_archiver_compresses_into_day_shards(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src_path = join(tmp_dir, 'rad9A6A3.csv')
+            shutil.copy(self.sample_filename(), src_path)
+            archive_dir = join(tmp_dir, 'archive')
+            archive_path = Archiver(archive_dir, compression='gzip').archive(
+                src_path, content_hash='abc', now=datetime(2015, 6, 3, 15, 21, 5))
             self.assertEqual(
-                len(import_history.result_identifiers.split(',')), 10)
+                archive_path, join(archive_dir, '2015', '06', '03', 'rad9A6A3.csv.20150603152105000000.abc.gz'))
+            self.assertFalse(os.path.exists(src_path))
+            with gzip.open(archive_path, 'rb') as f, open(self.sample_filename(), 'rb') as sample:
+                self.assertEqual(f.read(), sample.read())
+            self.assertEqual(ArchiveEntry.objects.get(content_hash='abc').archive_path, archive_path)
+            bundles = compact_archive(archive_dir, days=30, today=date(2015, 8, 1))
+            self.assertEqual(bundles, [join(archive_dir, '2015', '06', '20150603.tar')])
+            with tarfile.open(bundles[0]) as tar:
+                self.assertEqual(tar.getnames(), ['rad9A6A3.csv.20150603152105000000.abc.gz'])
+            self.assertFalse(os.path.exists(os.path.dirname(archive_path)))
+            self.assertEqual(ArchiveEntry.objects.get(content_hash='abc').bundle, bundles[0])
+            archiver = Archiver(archive_dir, compression='gzip')
+            archive_paths = []
+            for content_hash in ['def', 'ghi']:  # same name, same second
+                shutil.copy(self.sample_filename(), src_path)
+                archive_paths.append(archiver.archive(
+                    src_path, content_hash=content_hash, now=datetime(2015, 6, 3, 15, 21, 5)))
+            self.assertEqual(len(set(archive_paths)), 2)
+            self.assertTrue(all(os.path.exists(path) for path in archive_paths))
+            archive_path = archiver.get_archive_path('queued.csv', datetime(2015, 6, 4, 9, 0, 0))
+            reserved = [archiver.reserve_archive_path(archive_path) for _ in range(2)]  # both queued
+            self.assertEqual(reserved, [archive_path, archive_path.replace('.csv.gz', '.csv.1.gz')])
+            shutil.copy(self.sample_filename(), src_path)
+            archiver.compress(src_path, reserved[0], 'queued.csv', 'jkl')
+            self.assertEqual(archiver.reserved, set([reserved[1]]))
+            self.assertEqual(ArchiveEntry.objects.get(content_hash='jkl').archive_path, reserved[0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_mmap_reader_resumes_from_offset(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        rows = list(csv_result.iter_rows())
+        csv_result = CsvResult(self.csv_format, self.sample_filename(), use_mmap=True)
+        batches = csv_result.iter_batches(4)
+        self.assertEqual(list(next(batches).columns[0]), [values[0] for values in rows[:4]])
+        offset, line_num = csv_result.offset, csv_result.line_num
+        self.assertEqual(line_num, 5)
+        save_checkpoint(self.sample_filename(), offset, line_num)
+        checkpoint = get_checkpoint(self.sample_filename())
+        csv_result = CsvResult(
+            self.csv_format, self.sample_filename(), use_mmap=True,
+            start_offset=checkpoint.offset, start_line=checkpoint.line_num)
+        self.assertEqual(list(csv_result.iter_rows()), rows[4:])
+        self.assertEqual(list(csv_result.identifiers.values()), list(range(6, 12)))
+
+    def test_mmap_reader_stray_quote_and_read_error(self):
+        csv_result = CsvResult(self.csv_format, self.sample_filename())
+        rows = list(csv_result.iter_rows())
+        csv_result = CsvResult(self.csv_format, self.sample_filename(), start_line=5)
+        self.assertEqual(list(csv_result.iter_rows()), rows[4:])
+        with open(self.sample_filename(), 'rb') as f:
+            lines = f.read().split(b'\r')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = join(tmp_dir, 'rad9A6A3.csv')
+            fields = lines[2].split(b'\t')
+            fields[1] = b'O"Brien'
+            lines[2] = b'\t'.join(fields)
+            with open(path, 'wb') as f:
+                f.write(b'\r'.join(lines))
+            csv_result = CsvResult(self.csv_format, path, use_mmap=True)
+            self.assertEqual(list(csv_result.iter_rows()), list(CsvResult(self.csv_format, path).iter_rows()))
+            self.assertEqual(len(csv_result), 10)
+            lines[5] = lines[5] + b'\xff'
+            with open(path, 'wb') as f:
+                f.write(b'\r'.join(lines))
+            csv_result = CsvResult(self.csv_format, path, use_mmap=True)
+            self.assertRaises(CsvLoadError, list, csv_result.iter_rows())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tail_mode_imports_appended_lines(self):
+        save_handler = RecordingSaveHandler()
+        with open(self.sample_filename(), 'rb') as f:
+            lines = f.read().split(b'\r')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = join(tmp_dir, 'tail.csv')
+            with open(path, 'wb') as f:
+                f.write(b'\r'.join(lines[:5]))  # the fifth line is not complete yet
+            event_handler = CsvFileHandler(
+                csv_format=self.csv_format,
+                source_dir=tmp_dir,
+                archive_dir=None,
+                patterns=[],
+                tail_patterns=['tail*.csv'],
+                save_handler=save_handler,
+                save_handler_factory=lambda: save_handler,
+                verbose=False)
+            event_handler.process_existing_files()
+            self.assertEqual(save_handler.saved, ['AA11562', 'AA11528', 'AA11540'])
+            with open(path, 'ab') as f:
+                f.write(b'\r' + b'\r'.join(lines[5:7]) + b'\r')
+            event_handler.tail_file(path)
+            self.assertEqual(len(save_handler.saved), 6)
+            event_handler.tail_file(path)
+            self.assertEqual(len(save_handler.saved), 6)
+            with open(path, 'wb') as f:  # truncated and rewritten
+                f.write(b'\r'.join(lines[:3]) + b'\r')
+            event_handler.tail_file(path)
+            self.assertEqual(save_handler.saved[6:], ['AA11562', 'AA11528'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_rewritten_file_saves_changed_rows_only(self):
+        save_handler = RecordingSaveHandler()
+        with open(self.sample_filename(), 'rb') as f:
+            lines = f.read().split(b'\r')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = join(tmp_dir, 'rad9A6A3.csv')
+            shutil.copy(self.sample_filename(), path)
+            event_handler = CsvFileHandler(
+                csv_format=self.csv_format,
+                source_dir=tmp_dir,
+                archive_dir=None,
+                patterns=['*.csv'],
+                save_handler=save_handler,
+                verbose=False)
+            event_handler.read_csv_files(path)
+            self.assertEqual(len(save_handler.saved), 10)
+            row = lines[2].split(b'\t')
+            row[2] = b'corrected'  # the operator
+            lines[2] = b'\t'.join(row)
+            with open(path, 'wb') as f:
+                f.write(b'\r'.join(lines))
+            event_handler.read_csv_files(path)
+            self.assertEqual(save_handler.saved[10:], ['AA11528'])
+            self.assertEqual(RowFingerprint.objects.count(), 10)
+            items = list(CsvResult(self.csv_format, path).iter_items())
+            row_diff = RowDiff(self.csv_format.name, join(tmp_dir, 'other', 'rad9A6A3.csv'))
+            self.assertEqual(len(row_diff.changed(items)), 10)  # same name, other folder
+            row_diff = RowDiff(self.csv_format.name, path, keep_imports=1)
+            self.assertEqual((row_diff.import_number, row_diff.changed(items[:5])), (3, []))
+            row_diff.commit()
+            row_diff.prune()
+            self.assertEqual(RowFingerprint.objects.count(), 5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_folder_watch_emits_new_and_changed_files(self):
+
+        class RecordingEventHandler(CsvFileHandler):
+
+            def __init__(self, *args, **kwargs):
+                super(RecordingEventHandler, self).__init__(*args, **kwargs)
+                self.events = []
+
+            def process(self, event):
+                self.events.append((event.event_type, os.path.basename(event.src_path)))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(join(tmp_dir, 'archive'))
+            for filename in ['a.csv', 'b.txt']:
+                with open(join(tmp_dir, filename), 'w') as f:
+                    f.write('x')
+            event_handler = RecordingEventHandler(
+                csv_format=self.csv_format, source_dir=tmp_dir, archive_dir=None,
+                patterns=['*.csv'], verbose=False)
+            self.assertEqual(list(event_handler.matching_files), [join(tmp_dir, 'a.csv')])
+            folder_watch = FolderWatch(event_handler, tmp_dir)
+            folder_watch.scan(emit=False)
+            self.assertEqual(event_handler.events, [])
+            with open(join(tmp_dir, 'c.csv'), 'w') as f:
+                f.write('x')
+            with open(join(tmp_dir, 'a.csv'), 'a') as f:
+                f.write('y')
+            folder_watch.scan()
+            self.assertEqual(
+                sorted(event_handler.events), [('created', 'c.csv'), ('modified', 'a.csv')])
+            folder_watch.scan()
+            self.assertEqual(len(event_handler.events), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_polling_observer_first_poll_emits_no_events(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for filename in ['a.csv', 'b.csv']:
+                with open(join(tmp_dir, filename), 'w') as f:
+                    f.write('x')
+            events = []
+            event_handler = CsvFileHandler(
+                csv_format=self.csv_format, source_dir=tmp_dir, archive_dir=None,
+                patterns=['*.csv'], verbose=False)
+            event_handler.process = events.append
+            observer = ScandirPollingObserver()
+            observer.schedule(event_handler, path=tmp_dir)
+            observer.poll()
+            self.assertEqual(events, [])
+            os.remove(join(tmp_dir, 'a.csv'))
+            observer.poll()
+            self.assertEqual([(event.event_type, os.path.basename(event.src_path)) for event in events],
+                             [('deleted', 'a.csv')])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_polling_observer_routes_files_to_their_binding(self):
+        tmp_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            bindings = [
+                dict(csv_format=csv_format.name, source_dir=tmp_dir, patterns=['*.csv'], archive_dir=None)
+                for csv_format, tmp_dir in zip([self.csv_format, self.csv_format_vl], tmp_dirs)]
+            event_handlers = make_event_handlers(bindings, BaseSaveHandler, verbose=False)
+            observer = ScandirPollingObserver()
+            received = []
+            for event_handler in event_handlers:
+                events = []
+                received.append(events)
+                event_handler.process = lambda event, events=events: events.append(
+                    os.path.basename(event.src_path))
+                observer.schedule(event_handler, path=event_handler.source_dir)
+            for tmp_dir, filename in zip(tmp_dirs, ['cd4.csv', 'vl.csv']):
+                with open(join(tmp_dir, filename), 'w') as f:
+                    f.write('x')
+            observer.poll()
+            self.assertEqual(received, [['cd4.csv'], ['vl.csv']])
+        finally:
+            for tmp_dir in tmp_dirs:
+                shutil.rmtree(tmp_dir)
@@ -0,0 +1,63 @@
+import csv
+
+QUOTECHAR = '"'
+
+
+def ends_in_quotes(line, delimiter, in_quotes=False, quotechar=QUOTECHAR):
+    """Returns True if line ends inside a quoted value.
+
+    As with csv.reader a quote character only opens a quoted value at the start
+    of a field, so a stray quote in an unquoted value (e.g. O"Brien) is taken
+    literally. Within a quoted value a doubled quote character is an escaped
+    quote. in_quotes is the state at the start of the line. Works on str or bytes."""
+    quote = line.find(quotechar)
+    while quote != -1:
+        if in_quotes:
+            if line[quote + 1:quote + 2] == quotechar:
+                quote = line.find(quotechar, quote + 2)
+                continue
+            in_quotes = False
+        elif quote == 0 or line[quote - 1:quote] == delimiter:
+            in_quotes = True
+        quote = line.find(quotechar, quote + 1)
+    return in_quotes
+
+
+def iter_lines(lines, delimiter=','):
+    """Yields logical lines without line endings.
+
+    A line that ends inside a quoted value is joined with the following
+    lines, so a quoted value may span lines, see ends_in_quotes."""
+    pending = None
+    in_quotes = False
+    for line in lines:
+        if QUOTECHAR in line or in_quotes:
+            in_quotes = ends_in_quotes(line, delimiter, in_quotes)
+        if pending is not None:
+            line = pending + line
+            pending = None
+        if in_quotes:
+            pending = line
+            continue
+        yield line.rstrip('\r\n')
+    if pending is not None:
+        yield pending.rstrip('\r\n')
+
+
+def split_line(line, delimiter, maxsplit=-1):
+    """Returns the tokens of one line.
+
+    Splits on the delimiter unless the line contains a quote character,
+    in which case csv.reader is used."""
+    if QUOTECHAR in line:
+        return next(csv.reader([line], delimiter=delimiter, quotechar=QUOTECHAR))
+    return line.split(delimiter, maxsplit)
+
+
+def simple_split_reader(lines, delimiter):
+    """A replacement for csv.reader for files that (mostly) do not quote values.
+
+    `lines` is a file object opened with newline='' or any iterable of lines.
+    As with csv.reader a blank line is an empty row."""
+    for line in iter_lines(lines, delimiter):
+        yield split_line(line, delimiter) if line else []
@@ -0,0 +1,87 @@
+from operator import itemgetter
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .converters import DECIMAL, INTEGER
+from .tokenizer import iter_lines, split_line
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# raw values of a numeric column that are decoded to NaN
+NULL_VALUES = ('', '.')
+
+
+def check_numpy():
+    if np is None:
+        raise ImproperlyConfigured(
+            'The vectorised CSV loader requires numpy. Install numpy or use '
+            'CsvResult.iter_batches instead.')
+
+
+def iter_projected_rows(lines, delimiter, last_index):
+    """Yields each line as a list of tokens up to and including column last_index.
+
+    Columns after last_index are left unsplit in the last token, see split_line.
+    A blank line is yielded as a row of blank tokens, see RowFilter for skipping it."""
+    for line in iter_lines(lines, delimiter):
+        row = split_line(line, delimiter, last_index + 1)
+        if len(row) <= last_index:
+            row.extend([''] * (last_index + 1 - len(row)))
+        yield row
+
+
+def to_float_array(values):
+    """Returns values as a float64 array with NaN for blank values, or None
+    if any other value is not a number."""
+    array = np.char.strip(np.array(values, dtype=str))
+    array = np.where(np.isin(array, NULL_VALUES), 'nan', array)
+    try:
+        return array.astype(np.float64)
+    except ValueError:
+        return None
+
+
+class ColumnDecoder(object):
+    """Projects and decodes the mapped columns of rows in bulk for a FormatPlan.
+
+    Numeric utestid columns are decoded into NumPy float64 arrays with NaN for
+    blanks. A numeric column with a non-numeric value in the batch, and all
+    other columns, are decoded by the plan's converters. A column that is not
+    in the header is decoded to None."""
+
+    def __init__(self, format_plan):
+        check_numpy()
+        self.format_plan = format_plan
+        self.present = tuple(index is not None for index, _, _ in format_plan.columns)
+        indexes = [index for index, _, _ in format_plan.columns if index is not None]
+        self.last_index = max(indexes)
+        if len(indexes) > 1:
+            self.getter = itemgetter(*indexes)
+        else:
+            self.getter = lambda row: (row[indexes[0]], )
+        self.numeric = tuple(
+            datatype in [INTEGER, DECIMAL] for index, _, datatype in format_plan.columns
+            if index is not None)
+        self.converters = tuple(
+            convert for present, (_, convert) in zip(self.present, format_plan.converters) if present)
+
+    def iter_rows(self, lines):
+        return iter_projected_rows(lines, self.format_plan.delimiter, self.last_index)
+
+    def decode(self, rows):
+        """Returns a tuple of decoded columns for a list of projected rows."""
+        getter = self.getter
+        raw_columns = zip(*[getter(row) for row in rows])
+        decoded = []
+        for raw_column, numeric, convert in zip(raw_columns, self.numeric, self.converters):
+            column = to_float_array(raw_column) if numeric else None
+            if column is None:
+                column = [convert(value) for value in raw_column]
+            decoded.append(column)
+        if all(self.present):
+            return tuple(decoded)
+        decoded.reverse()
+        return tuple(decoded.pop() if present else [None] * len(rows) for present in self.present)
@@ -1,17 +1,50 @@
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.db.models import Q
 from django.views.generic import ListView
 
 from getresults_csv.models import ImportHistory
 
 
+def keyset_page(queryset, cursor=None, page_size=None):
+    """Returns (objects, next_cursor) for one page of queryset ordered by
+    -import_datetime, -id.
+
+    The cursor is the pk of the last object of the previous page. Rows after it
+    are selected with a range condition on the (import_datetime, id) index so
+    neither COUNT(*) nor OFFSET is needed. next_cursor is None on the last page."""
+    page_size = page_size or 25
+    queryset = queryset.order_by('-import_datetime', '-id')
+    if cursor:
+        try:
+            last = queryset.model.objects.values('import_datetime').get(pk=cursor)
+        except (queryset.model.DoesNotExist, ValueError):
+            pass
+        else:
+            older = Q(import_datetime__lt=last['import_datetime'])
+            same_time = Q(import_datetime=last['import_datetime'], id__lt=cursor)
+            queryset = queryset.filter(older | same_time)
+    objects = list(queryset[:page_size + 1])
+    if len(objects) > page_size:
+        return objects[:page_size], objects[page_size - 1].pk
+    return objects, None
+
+
 class ImportHistoryView(ListView):
-    queryset = ImportHistory.objects.all().order_by('-import_datetime')
+    """Lists the import history with keyset pagination, see keyset_page."""
+    queryset = ImportHistory.objects.all()
     context_object_name = 'importhistory_list'
     template_name = 'getresults_csv/importhistory_list.html'
-    paginate_by = 5
+    page_size = 25
+
+    def get_queryset(self):
+        objects, self.next_cursor = keyset_page(
+            super(ImportHistoryView, self).get_queryset(),
+            cursor=self.request.GET.get('after'),
+            page_size=self.page_size)
+        return objects
 
     def get_context_data(self, **kwargs):
         context = super(ImportHistoryView, self).get_context_data(**kwargs)
         context.update(
-            section_title='Import History')
+            section_title='Import History',
+            next_cursor=self.next_cursor)
         return context